@@ -0,0 +1,266 @@
+import argparse
+import gc
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+# runs fixed size, seeded benchmarks of both engines and prints a table, optionally writing the results as
+# json (--output) and flagging cases that got slower than in a saved run (--compare)
+#
+#   python benchmarks/run.py --output baseline.json
+#   ...change something...
+#   python benchmarks/run.py --compare baseline.json
+#
+# every call of a case gets its input built again from the same seed, so all repeats (and all runs) time
+# the same work, and the input building isn't timed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import salt_circles as top
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def load_circles_2():
+    # circles_2 is a directory of scripts that import each other by name, and its salt_circles would
+    # clash with the top-level one, so it is loaded under another name
+    directory = os.path.join(ROOT, "circles_2")
+    sys.path.append(directory)
+    spec = importlib.util.spec_from_file_location("circles_2_salt_circles", os.path.join(directory, "salt_circles.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+c2 = load_circles_2()
+
+
+# each benchmark yields (group, params, setup): setup(rng) builds the input from a seeded random.Random and
+# returns the function that is timed
+
+def top_runes(rng, count, radius, size = 15):
+    runes = [top.Circle(rng.randint(-size, size), rng.randint(-size, size), radius) for _ in range(count - 1)]
+    runes.append(top.StarredCircle(rng.randint(-size, size), rng.randint(-size, size), radius, rng = rng))
+    return runes
+
+def top_sizes():
+    # rune count at a fixed radius, then radius at a fixed rune count
+    for count in (5, 10, 20, 40):
+        yield count, 8
+    for radius in (4, 16):
+        yield 10, radius
+
+def top_simulate():
+    forces = [top.edge_attraction, top.strong_centration]
+    for count, radius in top_sizes():
+        def setup(rng, count = count, radius = radius):
+            runes = top_runes(rng, count, radius)
+            return lambda: top.simulate(runes, forces, iterations = 200, precision = 0.1)
+        yield "top.simulate", {"runes": count, "radius": radius}, setup
+
+def top_render():
+    for count, radius in top_sizes():
+        def setup(rng, count = count, radius = radius):
+            runes = top_runes(rng, count, radius)
+            return lambda: top.render(runes)
+        yield "top.render", {"runes": count, "radius": radius}, setup
+
+def top_predefined():
+    for count in (5, 10):
+        def setup(rng, count = count):
+            return lambda: top.predefined(rng = rng, count = count)
+        yield "top.predefined", {"count": count}, setup
+
+CANVASES = ((80, 40), (160, 80), (320, 160))
+OVERDRAW = (1, 4, 16)
+
+def c2_materials():
+    return [c2.Material("#", 2), c2.Material("."), c2.Material("*", 1), c2.Material("~", 1, 0.5), c2.Material("o", 0, 2)]
+
+def c2_pixel_buffer():
+    # overdraw layers, each a set of random rectangles covering about the whole canvas
+    for width, height in CANVASES:
+        for overdraw in OVERDRAW:
+            def setup(rng, width = width, height = height, overdraw = overdraw):
+                pb = c2.PixelBuffer(width, height)
+                materials = c2_materials()
+                for _ in range(overdraw):
+                    for _ in range(8):
+                        x0, y0 = rng.randrange(width), rng.randrange(height)
+                        pb.paint_rect(x0, y0, min(width - 1, x0 + width // 2), min(height - 1, y0 + height // 2), rng.choice(materials))
+                return lambda: pb.render(seed = 0)
+            yield "c2.PixelBuffer.render", {"width": width, "height": height, "overdraw": overdraw}, setup
+
+def c2_shape(kind, rng, materials):
+    # a primitive of about a quarter of the default viewport (+-20), somewhere in it
+    x, y = rng.uniform(-15, 15), rng.uniform(-15, 15)
+    edge, fill = rng.choice(materials), rng.choice(materials)
+    if kind == "Circle":
+        return c2.Circle(x, y, rng.uniform(4, 10), edge, fill)
+    if kind == "Line":
+        return c2.Line(x, y, rng.uniform(-20, 20), rng.uniform(-20, 20), edge)
+    points = [(x + 10 * math.cos(a) + rng.uniform(-2, 2), y + 10 * math.sin(a) + rng.uniform(-2, 2))
+        for a in [2 * math.pi * i / (3 if kind == "Triangle" else 7) for i in range(3 if kind == "Triangle" else 7)]]
+    if kind == "Triangle":
+        return c2.Triangle(*[c for point in points for c in point], edge, fill)
+    return c2.Polygon(points, edge, fill)
+
+def c2_primitives():
+    # rasterizing overdraw primitives into an empty scene, without resolving the buffer to text
+    for kind in ("Circle", "Line", "Triangle", "Polygon"):
+        for width, height in CANVASES:
+            for overdraw in OVERDRAW:
+                def setup(rng, kind = kind, width = width, height = height, overdraw = overdraw):
+                    materials = c2_materials()
+                    scene = c2.Scene(pixel_buffer = c2.PixelBuffer(width, height))
+                    objects = [c2_shape(kind, rng, materials) for _ in range(overdraw)]
+                    def run():
+                        for obj in objects:
+                            obj.render(scene)
+                    return run
+                yield f"c2.{kind}.render", {"width": width, "height": height, "overdraw": overdraw}, setup
+
+def c2_edge_constraint():
+    for vertices in (4, 16, 64, 256):
+        def setup(rng, vertices = vertices):
+            polygon = c2.PolygonS([c2.V(10 * math.cos(2 * math.pi * i / vertices), 10 * math.sin(2 * math.pi * i / vertices)) for i in range(vertices)])
+            angle = rng.uniform(0, 2 * math.pi)
+            circle = c2.CircleS(c2.V(20 * math.cos(angle), 20 * math.sin(angle)), 5)
+            constraint = c2.EdgeConstraint([polygon, circle], sensitivity = 0.01)
+            return constraint.apply
+        yield "c2.EdgeConstraint.apply", {"vertices": vertices}, setup
+
+BENCHMARKS = [top_simulate, top_render, top_predefined, c2_pixel_buffer, c2_primitives, c2_edge_constraint]
+
+
+def case_name(group, params):
+    return group + "[" + ",".join(f"{key}={value}" for key, value in params.items()) + "]"
+
+def cases(only = None):
+    for benchmark in BENCHMARKS:
+        for group, params, setup in benchmark():
+            name = case_name(group, params)
+            if only is None or any(part in name for part in only):
+                yield name, group, params, setup
+
+def time_sample(setup, number, seed):
+    # the time of one call, averaged over number calls, each on its own input (cases change their input,
+    # simulate moves the runes and apply the structures) built before the clock starts. the garbage
+    # collector is off while timing, like timeit does
+    runs = []
+    for _ in range(number):
+        random.seed(seed)
+        runs.append(setup(random.Random(seed)))
+    enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for run in runs:
+            run()
+        elapsed = time.perf_counter() - start
+    finally:
+        if enabled:
+            gc.enable()
+    return elapsed / number
+
+def time_case(setup, repeat, seed, min_time = 0.02, max_number = 1000):
+    # short cases are called enough times per sample for a sample to take min_time, single calls of
+    # tens of microseconds are mostly timer and scheduler noise. the calibrating sample isn't kept and
+    # doubles as a warm up
+    per_call = time_sample(setup, 1, seed)
+    number = max(1, min(max_number, math.ceil(min_time / max(per_call, 1e-9))))
+    return [time_sample(setup, number, seed) for _ in range(repeat)], number
+
+def run_all(only = None, repeat = 5, seed = 0, out = sys.stdout):
+    results = {}
+    for name, group, params, setup in cases(only):
+        times, number = time_case(setup, repeat, seed)
+        results[name] = {"group": group, "params": params, "min": min(times), "median": statistics.median(times), "number": number, "times": times}
+        out.write(f"{name:<60} {format_time(min(times)):>10} {format_time(statistics.median(times)):>10}\n")
+        out.flush()
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": None if np is None else np.__version__,
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "seed": seed,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f}us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.2f}ms"
+    return f"{seconds:.3f}s"
+
+def compare(baseline, current, threshold = 0.25, floor = 1e-6, only = None, out = sys.stdout):
+    # a case regressed when its best time is more than threshold slower than the baseline's, ignoring
+    # differences under floor seconds. returns the names of the regressed cases
+    regressions = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            out.write(f"{name:<60} {'new':>10}\n")
+            continue
+        before = baseline["results"][name]["min"]
+        after = result["min"]
+        ratio = after / before if before > 0 else math.inf
+        flag = ""
+        if ratio > 1 + threshold and after - before > floor:
+            flag = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold) and before - after > floor:
+            flag = "faster"
+        out.write(f"{name:<60} {format_time(before):>10} {format_time(after):>10} {ratio:>7.2f}x {flag}\n")
+    for name in baseline["results"]:
+        if name not in current["results"] and (only is None or any(part in name for part in only)):
+            out.write(f"{name:<60} {'missing':>10}\n")
+    return regressions
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default = None, help = "file to write the results to as json")
+    parser.add_argument("--compare", default = None, help = "json results of an earlier run to flag regressions against")
+    parser.add_argument("--current", default = None, help = "with --compare, json results to compare instead of running the benchmarks")
+    parser.add_argument("--threshold", type = float, default = 0.25, help = "slowdown (as a fraction) that counts as a regression")
+    parser.add_argument("--repeat", type = int, default = 5, help = "timed samples per case, the best and the median are kept")
+    parser.add_argument("--seed", type = int, default = 0, help = "seed the inputs are built from")
+    parser.add_argument("--only", action = "append", default = None, help = "run only cases whose name contains this (can be given more than once)")
+    parser.add_argument("--list", action = "store_true", help = "list the case names and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, _, _, _ in cases(args.only):
+            print(name)
+        sys.exit(0)
+
+    if args.current is not None:
+        current = load(args.current)
+    else:
+        current = run_all(args.only, args.repeat, args.seed)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent = 2)
+    if args.compare is not None:
+        print()
+        regressions = compare(load(args.compare), current, args.threshold, only = args.only)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}")
+            sys.exit(1)
@@ -0,0 +1,83 @@
+class SweepAndPrune:
+    # a broad phase: the bounding boxes (location + extent(), grown by margin) of a set of structures,
+    # kept sorted by their low end along one axis (0 for x, 1 for y), so that the pairs of structures
+    # whose boxes overlap can be found in one sweep without looking at every pair.
+    # a structure that is added tells the broad phase when it moves or changes shape, its box is worked
+    # out again and put back in order on the next pairs() call. after small moves the order is nearly
+    # right already, so an insertion sort puts it back in close to linear time
+    def __init__(self, structures = None, axis = 0, margin = 0):
+        self.axis = axis
+        self.margin = margin
+        self.boxes = {} #id(structure) -> [x_min, y_min, x_max, y_max, structure]
+        self.order = [] #the boxes, sorted by their low end along axis
+        self.stale = {}
+        for structure in structures or []:
+            self.add(structure)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __contains__(self, structure):
+        return id(structure) in self.boxes
+
+    def box(self, structure):
+        x_min, y_min, x_max, y_max = structure.extent()
+        location = structure.location
+        return [location.x + x_min - self.margin, location.y + y_min - self.margin,
+            location.x + x_max + self.margin, location.y + y_max + self.margin, structure]
+
+    def add(self, structure):
+        if id(structure) in self.boxes:
+            return
+        if structure.broad_phase is not None:
+            raise Exception("structure is already in a broad phase")
+        box = self.box(structure)
+        self.boxes[id(structure)] = box
+        self.order.append(box)
+        self.order.sort(key=lambda box: box[self.axis])
+        structure.broad_phase = self
+
+    def remove(self, structure):
+        box = self.boxes.pop(id(structure))
+        self.order.remove(box)
+        self.stale.pop(id(structure), None)
+        structure.broad_phase = None
+
+    def moved(self, structure):
+        #called by the structure after a move or a change of shape
+        self.stale[id(structure)] = structure
+
+    def update(self):
+        #refreshes the boxes of the structures that changed and restores the order
+        if not self.stale:
+            return
+        for structure in self.stale.values():
+            self.boxes[id(structure)][:4] = self.box(structure)[:4]
+        self.stale = {}
+        order = self.order
+        axis = self.axis
+        for i in range(1, len(order)):
+            box = order[i]
+            j = i
+            while j > 0 and order[j - 1][axis] > box[axis]:
+                order[j] = order[j - 1]
+                j -= 1
+            order[j] = box
+
+    def pairs(self):
+        #the (structure, structure) pairs whose boxes overlap, the one that comes first along the axis first
+        self.update()
+        low = self.axis
+        high = self.axis + 2
+        other_low = 1 - self.axis
+        other_high = 3 - self.axis
+        pairs = []
+        active = []
+        for box in self.order:
+            #boxes that end before this one starts can't overlap it, or anything after it
+            active = [other for other in active if other[high] >= box[low]]
+            for other in active:
+                if other[other_low] <= box[other_high] and box[other_low] <= other[other_high]:
+                    pairs.append((other[4], box[4]))
+            active.append(box)
+        return pairs
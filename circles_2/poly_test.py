@@ -1,6 +1,7 @@
 import random
 from render import *
 import math
+import sys
 import time
 
 edge_mats = Material.list_to_mat("0#$@",1)
@@ -14,22 +15,25 @@ rotation = 0
 grow = True
 speed = 0.5
 radius = 10
+
+# one retained scene for the whole animation, each frame only moves the shapes and redraws what changed
+gon = Polygon([],edge_mats,fill_mat)
+circle = Circle(0,0,radius, edge_mats)
+scene = Scene([gon,circle])
 while True:
     #gon points
     points = []
     for i in range(ngon):
         points.append((radius*math.cos(i*2*math.pi/ngon + rotation),radius*math.sin(i*2*math.pi/ngon + rotation)))
 
+    gon.points = points
+    circle.radius = radius
+    scene.update(gon)
+    scene.update(circle)
 
-    gon = Polygon(points,edge_mats,fill_mat)
-    circle = Circle(0,0,radius, edge_mats)
-
-    objects = [gon,circle]
-
-    scene = Scene(objects)
+    sys.stdout.write(scene.render_diff())
+    sys.stdout.flush()
 
-    print(scene.render())
-    
     if grow:
         radius += speed
         if radius >= 17:
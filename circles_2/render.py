@@ -1,23 +1,221 @@
+import collections
+import concurrent.futures
+import math
 import random
+import types
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class PixelBuffer():
-    # holds a 2D array of material lists 
-    def __init__(self, width, height, background = None):
+    # z-buffer of materials: for every pixel it keeps the highest priority painted there so far and the
+    # materials painted at exactly that priority, anything lower can never show up so it is dropped as
+    # soon as it is painted over. materials are interned into a palette and the tied ones are kept in
+    # paint order as (palette index, times painted) runs, since a material painted twice counts twice
+    # in the mix but painting the same one over and over shouldn't cost memory.
+    # those runs are interned too (as "ties"), so a pixel is just a tie index, and painting a material
+    # onto a tie is a cached lookup of the tie it turns into. a tie is stored as its last run and the tie
+    # of the runs before it, so a tie made by painting over another costs the same little memory however
+    # many runs it has: the tie state grows with the number of distinct ties painted (at most one more
+    # per material painted at a tie's priority), not with their length or with width x height
+    # a buffer can hold just an area of a width x height picture (eg. one tile of it): coordinates stay
+    # those of the whole picture, and paints outside the area are dropped
+    def __init__(self, width, height, background = None, area = None):
         self.width = width
         self.height = height
         if background is None:
             background = Material(' ',-1)
-        self.buffer = [[[background] for x in range(width)] for y in range(height)]
+        self.background_material = background
+        if area is None:
+            area = (0, 0, width - 1, height - 1)
+        # (x0, y0, x1, y1) rectangle held, corners included, stored row by row stride pixels apart
+        self.area = area
+        self.stride = area[2] - area[0] + 1
+        self.rows = area[3] - area[1] + 1
+        self.origin = area[1] * self.stride + area[0]
+        self.palette = []
+        self.palette_index = {}
+        self.ties = []
+        self.tie_index = {}
+        self.tie_priority = []
+        self.transitions = {}
+        self.background = self.intern_tie((-1, self.intern(background), 1))
+        self.tied = [self.background] * (self.stride * self.rows)
+        # (x0, y0, x1, y1) rectangle, corners included, that paints are confined to, None for the whole area
+        self.clip = None
+        # the bytearray render_into writes to when it isn't given one
+        self.output = None
+
+    def window(self):
+        # the paintable rectangle as (x0, y0, x1, y1), corners included
+        if self.clip is None:
+            return self.area
+        x0, y0, x1, y1 = self.clip
+        return (max(x0, self.area[0]), max(y0, self.area[1]), min(x1, self.area[2]), min(y1, self.area[3]))
+
+    def clear_rect(self, x0, y0, x1, y1):
+        # resets the rectangle from (x0, y0) to (x1, y1), corners included, to the background
+        x0 = max(x0, self.area[0])
+        x1 = min(x1, self.area[2])
+        for y in range(max(y0, self.area[1]), min(y1, self.area[3]) + 1):
+            if x0 <= x1:
+                start = y * self.stride + x0 - self.origin
+                self.tied[start:start + x1 - x0 + 1] = [self.background] * (x1 - x0 + 1)
+
+    def intern(self, mat):
+        # index of the material in the palette, materials that render the same share an entry
+        key = (mat.char, mat.priority, mat.mix)
+        index = self.palette_index.get(key)
+        if index is None:
+            index = len(self.palette)
+            self.palette.append(mat)
+            self.palette_index[key] = index
+        return index
+
+    def intern_tie(self, tie):
+        # tie is (tie of the runs before the last one or -1, palette index, times painted) of the last run
+        index = self.tie_index.get(tie)
+        if index is None:
+            index = len(self.ties)
+            self.ties.append(tie)
+            self.tie_priority.append(self.palette[tie[1]].priority)
+            self.tie_index[tie] = index
+        return index
+
+    def tie_runs(self, tie):
+        # the (palette index, times painted) runs of a tie in paint order
+        runs = []
+        while tie >= 0:
+            tie, index, count = self.ties[tie]
+            runs.append((index, count))
+        runs.reverse()
+        return runs
+
+    def paint_tie(self, tie, mat):
+        # the tie a pixel ends up with when mat is painted over tie
+        index = self.intern(mat)
+        painted = self.transitions.get((tie, index))
+        if painted is None:
+            if mat.priority > self.tie_priority[tie]:
+                painted = self.intern_tie((-1, index, 1))
+            elif mat.priority == self.tie_priority[tie]:
+                before, last, count = self.ties[tie]
+                if last == index:
+                    painted = self.intern_tie((before, index, count + 1))
+                else:
+                    painted = self.intern_tie((tie, index, 1))
+            else:
+                painted = tie
+            self.transitions[(tie, index)] = painted
+        return painted
+
+    def materials(self, mat):
+        # the materials painted by mat, which is either a Material or a list of Materials
+        if type(mat) is Material:
+            return (mat,)
+        elif type(mat) is list:
+            return mat
+        raise TypeError('mat must be a Material or a list of Materials')
+
+    def painter(self, mat):
+        # returns a function mapping a tie to the tie it turns into when mat is painted over it,
+        # memoized so a bulk paint only works out each distinct tie it covers once
+        mats = self.materials(mat)
+        painted = {}
+        def paint(tie):
+            result = painted.get(tie)
+            if result is None:
+                result = tie
+                for m in mats:
+                    result = self.paint_tie(result, m)
+                painted[tie] = result
+            return result
+        return paint
 
     def paint_pixel(self, x, y, mat):
         # adds a material to the pixel buffer at the given coordinates
-        if x >= 0 and x < self.width and y >= 0 and y < self.height:
-            if type(mat) is Material:
-                self.buffer[y][x].append(mat)
-            elif type(mat) is list:
-                self.buffer[y][x] += mat
+        self.paint_points(((x, y),), mat)
+
+    def paint_points(self, points, mat):
+        # paints every (x, y) point in order, points outside the buffer (or clip) are skipped and a point
+        # listed twice is painted twice
+        x0, y0, x1, y1 = self.window()
+        paint = None
+        for x, y in points:
+            if x >= x0 and x <= x1 and y >= y0 and y <= y1:
+                if paint is None:
+                    paint = self.painter(mat)
+                i = y * self.stride + x - self.origin
+                self.tied[i] = paint(self.tied[i])
+
+    def paint_span(self, y, x0, x1, mat):
+        # paints row y from x0 to x1, both included
+        self.paint_rect(x0, y, x1, y, mat)
+
+    def paint_rect(self, x0, y0, x1, y1, mat):
+        # paints the rectangle from (x0, y0) to (x1, y1), corners included
+        # clipped once, then each row is rewritten as a slice
+        window = self.window()
+        x0 = max(x0, window[0])
+        y0 = max(y0, window[1])
+        x1 = min(x1, window[2])
+        y1 = min(y1, window[3])
+        if x0 > x1 or y0 > y1:
+            return
+        paint = self.painter(mat)
+        for y in range(y0, y1 + 1):
+            self.paint_row(y, x0, x1, paint)
+
+    def paint_spans(self, spans, mat):
+        # paints (y, x0, x1) spans, x0 to x1 both included, all of them with mat
+        wx0, wy0, wx1, wy1 = self.window()
+        paint = None
+        for y, x0, x1 in spans:
+            x0 = max(x0, wx0)
+            x1 = min(x1, wx1)
+            if x0 > x1 or y < wy0 or y > wy1:
+                continue
+            if paint is None:
+                paint = self.painter(mat)
+            self.paint_row(y, x0, x1, paint)
+
+    def paint_row(self, y, x0, x1, paint):
+        # rewrites row y from x0 to x1 (already clipped) through a painter, as one slice
+        start = y * self.stride + x0 - self.origin
+        end = start + x1 - x0 + 1
+        row = self.tied[start:end]
+        if row.count(row[0]) == len(row):
+            self.tied[start:end] = [paint(row[0])] * len(row)
+        else:
+            self.tied[start:end] = [paint(tie) for tie in row]
+
+    def paint_mask(self, mask, origin, mat):
+        # paints the pixels where a 2d boolean mask (rows of booleans, or a numpy array) is set, with
+        # mask[0][0] landing on origin = (x, y) in the buffer
+        ox, oy = origin
+        x0, y0, x1, y1 = self.window()
+        row_start = max(y0 - oy, 0)
+        row_end = min(len(mask), y1 + 1 - oy)
+        paint = None
+        for my in range(row_start, row_end):
+            row = mask[my]
+            column_start = max(x0 - ox, 0)
+            column_end = min(len(row), x1 + 1 - ox)
+            if column_start >= column_end:
+                continue
+            if np is not None and isinstance(row, np.ndarray):
+                columns = (np.flatnonzero(row[column_start:column_end]) + column_start).tolist()
             else:
-                raise TypeError('mat must be a Material or a list of Materials')
+                columns = [mx for mx in range(column_start, column_end) if row[mx]]
+            if not columns:
+                continue
+            if paint is None:
+                paint = self.painter(mat)
+            offset = (my + oy) * self.stride + ox - self.origin
+            for mx in columns:
+                self.tied[offset + mx] = paint(self.tied[offset + mx])
 
     def viewport_to_buffer(self, x, y):
         # transforms a point in viewport coordinates (-1,1) to pixel buffer coordinates
@@ -26,28 +224,250 @@ class PixelBuffer():
         y = round((y + 1) / 2 * self.height)
         return (x, y)
 
-    def render(self, seed = 0):
-        s = ''
-        random.seed(seed)
-        for row in self.buffer:
-            for pixel in row:
-                max_priority = max([mat.priority for mat in pixel])
-                max_priority_mats = [mat for mat in pixel if mat.priority == max_priority]
-                sum_mix = sum([mat.mix for mat in max_priority_mats])
-                r = random.random() * sum_mix
-                for mat in max_priority_mats:
+    def render(self, seed = 0, compat = False):
+        return ''.join(self.render_rows(seed, compat))
+
+    def render_rows(self, seed = 0, compat = False, band = 32):
+        # yields the rendered buffer one finished row (with its newline) at a time
+        # each pixel picks one of its tied materials at random, weighted by mix, from a generator seeded
+        # with seed (the global random module is left alone). compat picks exactly like renders before
+        # the batched resolve did, with one random.random() per pixel in order, so old seeds give the
+        # same frames; otherwise the pixels are resolved in numpy passes over band rows at a time
+        if compat or np is None:
+            return self.render_rows_compat(seed)
+        return self.render_rows_batched(seed, band)
+
+    def tied_materials(self, tie):
+        # the tied materials of a pixel spelled out in paint order, and their total mix
+        mats = [self.palette[i] for i, count in self.tie_runs(tie) for _ in range(count)]
+        return mats, sum([mat.mix for mat in mats])
+
+    def render_rows_compat(self, seed = 0):
+        # the draws of pixels outside the area are skipped over, so an area renders as the same part of
+        # the whole picture would
+        rng = random.Random(seed)
+        mixes = {}
+        drawn = 0
+        for y in range(self.rows):
+            for _ in range((self.area[1] + y) * self.width + self.area[0] - drawn):
+                rng.random()
+            drawn = (self.area[1] + y) * self.width + self.area[2] + 1
+            s = []
+            for tie in self.tied[y * self.stride:(y + 1) * self.stride]:
+                mats = mixes.get(tie)
+                if mats is None:
+                    mats = mixes[tie] = self.tied_materials(tie)
+                mats, sum_mix = mats
+                r = rng.random() * sum_mix
+                for mat in mats:
                     r -= mat.mix
                     if r <= 0:
-                        s += mat.char
-                        s += ' '
+                        s.append(mat.char)
+                        s.append(' ')
                         break
-            s += '\n'
-        return s
+            s.append('\n')
+            yield ''.join(s)
+
+    def render_rows_batched(self, seed = 0, band = 32):
+        # resolved band rows at a time, so only a band's arrays and strings are held at once and the
+        # first rows go out before the rest are resolved
+        mixes = {}
+        for first in range(0, self.rows, band):
+            rows = min(band, self.rows - first)
+            cells, picked = self.resolve(seed, first, rows, mixes)
+            cells = np.array(cells, dtype=object)
+            for row in cells[picked].reshape(rows, self.stride).tolist():
+                yield ''.join(row) + '\n'
+
+    def resolve(self, seed = 0, first = 0, rows = None, mixes = None):
+        # the batched resolve of rows first to first + rows of the buffer (all of them by default),
+        # returns the cells (character and space) the pixels can show and for every pixel the index of
+        # the cell it picked. each pixel gets the draw it has in the stream of the whole picture, so
+        # resolving in bands picks exactly what resolving at once does.
+        # every tie is resolved for all of its pixels at once: one draw per pixel, scaled by the total
+        # mix and looked up in the cumulative mixes. mixes caches tied_materials across calls
+        if rows is None:
+            rows = self.rows - first
+        if mixes is None:
+            mixes = {}
+        tie_of = np.array(self.tied[first * self.stride:(first + rows) * self.stride], dtype=np.intp)
+        if self.stride == self.width:
+            draws = self.draws(seed, (self.area[1] + first) * self.width + self.area[0], len(tie_of))
+        else:
+            draws = np.concatenate([self.draws(seed, (self.area[1] + y) * self.width + self.area[0], self.stride) for y in range(first, first + rows)])
+
+        # pixels sorted by tie, so each tie's pixels are one slice
+        order = np.argsort(tie_of, kind='stable')
+        ties, counts = np.unique(tie_of, return_counts=True)
+        ends = np.cumsum(counts)
+
+        cells = []
+        picked = np.zeros(len(tie_of), dtype=np.intp)
+        for tie, start, end in zip(ties.tolist(), (ends - counts).tolist(), ends.tolist()):
+            pixels = order[start:end]
+            if tie not in mixes:
+                mixes[tie] = self.tied_materials(tie)
+            mats, sum_mix = mixes[tie]
+            first_cell = len(cells)
+            cells += [mat.char + ' ' for mat in mats]
+            if len(mats) == 1:
+                picked[pixels] = first_cell
+                continue
+            bounds = np.cumsum([mat.mix for mat in mats])
+            choice = np.searchsorted(bounds, draws[pixels] * sum_mix, side='left')
+            picked[pixels] = first_cell + np.minimum(choice, len(mats) - 1)
+        return cells, picked
+
+    def render_into(self, out = None, seed = 0, compat = False):
+        # the rendered text, utf-8 encoded, written into a bytearray and returned as a memoryview of it,
+        # ready for sys.stdout.buffer or a socket. out is used if it is big enough, otherwise (and when it
+        # isn't given) a bytearray kept by the buffer is, so rendering frame after frame reuses the same
+        # memory. when every character is ascii rows are a fixed 2 * width + 1 bytes apart and the batched
+        # resolve writes the cells straight into it
+        row_stride = 2 * self.stride + 1
+        size = self.rows * row_stride
+        if compat or np is None:
+            return self.write_into(out, ''.join(self.render_rows_compat(seed)).encode())
+
+        cells, picked = self.resolve(seed)
+        encoded = ''.join(cells).encode()
+        if len(encoded) != 2 * len(cells):
+            # a multi byte character somewhere, so rows differ in length
+            cells = np.array(cells, dtype=object)
+            return self.write_into(out, ''.join([''.join(row) + '\n' for row in cells[picked].reshape(self.rows, self.stride).tolist()]).encode())
+
+        out = self.output_buffer(out, size)
+        frame = np.frombuffer(out, dtype=np.uint8, count=size).reshape(self.rows, row_stride)
+        frame[:, -1] = ord('\n')
+        frame[:, :-1].reshape(self.rows, self.stride, 2)[...] = np.frombuffer(encoded, dtype=np.uint8).reshape(-1, 2)[picked.reshape(self.rows, self.stride)]
+        return memoryview(out)[:size]
+
+    def output_buffer(self, out, size):
+        if out is None or len(out) < size:
+            if out is None and self.output is not None and len(self.output) >= size:
+                return self.output
+            out = bytearray(size)
+            self.output = out
+        return out
+
+    def write_into(self, out, data):
+        out = self.output_buffer(out, len(data))
+        out[:len(data)] = data
+        return memoryview(out)[:len(data)]
+
+    def draws(self, seed, start, count):
+        # draws start to start + count of the stream the batched resolve gives the whole picture, one per
+        # pixel in row order, so an area picks exactly what the same pixels of the whole picture do
+        bits = np.random.PCG64(stream_seed(seed))
+        bits.advance(start)
+        return np.random.Generator(bits).random(count)
 
     def __str__(self):
         return self.render()
                 
 
+def stream_seed(seed):
+    # PCG64 only takes non-negative ints, any other seed random.seed takes (negative, float, str, bytes,
+    # None) is turned into one through random.Random, non-negative ints are kept so their pictures don't change
+    if isinstance(seed, int) and not isinstance(seed, bool) and seed >= 0:
+        return seed
+    return random.Random(seed).getrandbits(128)
+
+class Recorder():
+    # stands in for the pixel buffer while an object rasterizes and writes its paints down instead, so they
+    # can be replayed onto any buffer of the same size later. the window is always the whole picture,
+    # replaying applies the clip and area of the buffer it is replayed onto. spans painted one after
+    # another with the same material are kept together as one paint_spans
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.paints = []
+        # rough size of the recording in bytes, about 16 per point and 24 per span
+        self.size = 64
+
+    def window(self):
+        return (0, 0, self.width - 1, self.height - 1)
+
+    def paint_pixel(self, x, y, mat):
+        self.paint_points(((x, y),), mat)
+
+    def paint_points(self, points, mat):
+        points = list(points)
+        self.paints.append(('paint_points', (points, mat)))
+        self.size += 16 * len(points)
+
+    def paint_span(self, y, x0, x1, mat):
+        if self.paints and self.paints[-1][0] == 'paint_spans' and self.paints[-1][1][1] is mat:
+            self.paints[-1][1][0].append((y, x0, x1))
+        else:
+            self.paints.append(('paint_spans', ([(y, x0, x1)], mat)))
+        self.size += 24
+
+    def paint_rect(self, x0, y0, x1, y1, mat):
+        for y in range(max(y0, 0), min(y1, self.height - 1) + 1):
+            self.paint_span(y, x0, x1, mat)
+
+    def paint_mask(self, mask, origin, mat):
+        # the mask is kept as given, not copied
+        self.paints.append(('paint_mask', (mask, origin, mat)))
+        self.size += sum([len(row) for row in mask])
+
+    def replay(self, pb):
+        for method, args in self.paints:
+            getattr(pb, method)(*args)
+
+class RasterCache():
+    # LRU of object rasterizations (Recorders), keyed by the object's geometry and materials and the
+    # transform and size of the picture, holding at most max_bytes of them (by their estimated size).
+    # a scene given a cache replays an object's recorded paints instead of rasterizing it again
+    def __init__(self, max_bytes = 16*1024*1024):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def paint(self, obj, scene):
+        key = obj.raster_key()
+        if key is None:
+            obj.render(scene)
+            return
+        pb = scene.pixel_buffer
+        transform = scene.transform
+        key = (key, transform.x_scale, transform.x_offset, transform.y_scale, transform.y_offset, pb.width, pb.height)
+        recording = self.entries.get(key)
+        if recording is None:
+            self.misses += 1
+            recording = Recorder(pb.width, pb.height)
+            obj.render(types.SimpleNamespace(pixel_buffer = recording, viewport = scene.viewport, transform = transform))
+            self.remember(key, recording)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        recording.replay(pb)
+
+    def remember(self, key, recording):
+        if recording.size > self.max_bytes:
+            return
+        self.entries[key] = recording
+        self.bytes += recording.size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last = False)
+            self.bytes -= evicted.size
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+        }
+
 class Viewport():
     # holds the coordinate bounds of a viewport and a pixel buffer
     def __init__(self, x_min, x_max, y_min, y_max):
@@ -65,11 +485,73 @@ class Viewport():
         y = (y - self.y_min) / self.height * 2 - 1
         return (x, y)
 
+class Transform():
+    # the world -> viewport -> pixel buffer mapping folded into one affine transform per axis,
+    # x * scale + offset rounded to the nearest pixel.
+    # this is not always the pixel the two steps (Viewport.world_to_viewport then
+    # PixelBuffer.viewport_to_buffer) give: a point exactly halfway between two pixels is rounded here
+    # as the exact half, to the even pixel like round() does, where the two steps round a value float
+    # error has already pushed a little to one side or the other (eg. world x -19.5 and -18.5 in the
+    # default 40 x 40 scene go to pixels 0 and 2 here, and to 1 and 1 there). points off the halves
+    # land on the same pixel either way.
+    # length() also measures differently from the two steps it replaced: it is the pixel distance from
+    # world 0 to the length, where the two steps subtracted the pixel of the viewport's centre instead.
+    # that only agrees for a viewport centred on the origin, anywhere else circles used to come out the
+    # wrong size, often with a negative radius that drew nothing (eg. a radius 5 circle with viewport
+    # (0, 40, 0, 40) at 20 x 20 was -8 pixels and is now 2)
+    def __init__(self, viewport, pixel_buffer):
+        self.x_scale = pixel_buffer.width / viewport.width
+        self.y_scale = pixel_buffer.height / viewport.height
+        self.x_offset = -viewport.x_min * self.x_scale
+        self.y_offset = -viewport.y_min * self.y_scale
+
+    def point(self, x, y):
+        # transforms a point in world coordinates to pixel buffer coordinates
+        return (round(x * self.x_scale + self.x_offset), round(y * self.y_scale + self.y_offset))
+
+    def points(self, points):
+        # transforms a sequence (or n x 2 array) of world points in one go, returns a list of (x, y) tuples
+        if np is None:
+            return [self.point(x, y) for x, y in points]
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        x = np.rint(points[:, 0] * self.x_scale + self.x_offset).astype(int)
+        y = np.rint(points[:, 1] * self.y_scale + self.y_offset).astype(int)
+        return list(zip(x.tolist(), y.tolist()))
+
+    def length(self, length):
+        # a world distance along x in whole pixels, measured from world 0 (see above)
+        return round(length * self.x_scale + self.x_offset) - round(self.x_offset)
+
+def rects_overlap(a, b):
+    # whether two (x0, y0, x1, y1) rectangles, corners included, share a pixel
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def merge_rects(rects):
+    # merges overlapping rectangles into their bounding rectangles until none overlap
+    merged = []
+    for rect in rects:
+        i = 0
+        while i < len(merged):
+            if rects_overlap(merged[i], rect):
+                other = merged.pop(i)
+                rect = (min(rect[0], other[0]), min(rect[1], other[1]), max(rect[2], other[2]), max(rect[3], other[3]))
+                i = 0
+            else:
+                i += 1
+        merged.append(rect)
+    return merged
+
 class Scene():
     # holds a list of objects to be rendered, the coordinate bounds of a viewport, and a pixel buffer
     # the viewport is a rectangle in the scene that will be rendered to the pixel buffer
-
-    def __init__(self, objects = [], viewport = None, pixel_buffer = None):
+    # the scene is retained: the pixel buffer keeps what was rendered, and each render only repaints the
+    # screen rectangles of objects that were added, removed or updated since the last one (before and
+    # after the change). objects can be added with add() or by appending to objects, but an object that
+    # is changed in place has to be passed to update() to be redrawn
+
+    def __init__(self, objects = None, viewport = None, pixel_buffer = None, cache = None):
+        if objects is None:
+            objects = []
         self.objects = objects
         if viewport is None:
             viewport = Viewport(-20, 20, -20, 20)
@@ -77,11 +559,181 @@ class Scene():
         if pixel_buffer is None:
             pixel_buffer = PixelBuffer(40, 40)
         self.pixel_buffer = pixel_buffer
-
-    def render(self):
+        self.transform_key = None
+        # the clipped screen rectangle of every object as of the last refresh, and the objects updated since
+        self.boxes = {}
+        self.changed = set()
+        self.refreshed = None
+        # the rows last written by render_diff
+        self.frame = None
+        # optional RasterCache objects are painted through
+        self.cache = cache
+
+    def add(self, obj):
+        self.objects.append(obj)
+
+    def remove(self, obj):
+        self.objects.remove(obj)
+
+    def update(self, obj):
+        # marks an object that was changed in place so the next render redraws it
+        self.changed.add(obj)
+
+    def screen_box(self, obj):
+        # the object's screen rectangle clipped to the pixel buffer, None when it is off screen
+        box = obj.bounds(self)
+        if box is None:
+            return None
+        pb = self.pixel_buffer
+        box = (max(box[0], 0), max(box[1], 0), min(box[2], pb.width - 1), min(box[3], pb.height - 1))
+        if box[0] > box[2] or box[1] > box[3]:
+            return None
+        return box
+
+    def refresh(self):
+        # brings the pixel buffer up to date with the objects, returns the rectangles that were repainted
+        pb = self.pixel_buffer
+        whole = (0, 0, pb.width - 1, pb.height - 1)
+        # a different transform (or the first render) moves everything
+        transform = self.transform
+        full = self.refreshed is not transform
+
+        boxes = {}
+        dirty = []
         for obj in self.objects:
+            if obj in boxes:
+                continue
+            if not full and obj in self.boxes and obj not in self.changed:
+                boxes[obj] = self.boxes[obj]
+                continue
+            boxes[obj] = self.screen_box(obj)
+            dirty += [box for box in (self.boxes.get(obj), boxes[obj]) if box is not None]
+        dirty += [box for obj, box in self.boxes.items() if obj not in boxes and box is not None]
+        self.boxes = boxes
+        self.changed = set()
+        self.refreshed = transform
+
+        dirty = merge_rects(dirty)
+        # repainting lots of small rectangles costs more than one pass over the buffer
+        if full or sum([(x1 - x0 + 1) * (y1 - y0 + 1) for x0, y0, x1, y1 in dirty]) >= pb.width * pb.height:
+            dirty = [whole]
+
+        for rect in dirty:
+            # clear the rectangle and paint every object touching it, in order, confined to it
+            pb.clear_rect(*rect)
+            pb.clip = None if rect == whole else rect
+            try:
+                for obj in self.objects:
+                    if boxes[obj] is not None and rects_overlap(boxes[obj], rect):
+                        self.paint(obj)
+            finally:
+                pb.clip = None
+        return dirty
+
+    @property
+    def transform(self):
+        # the world -> pixel buffer transform, rebuilt only when the viewport or pixel buffer (or their
+        # bounds and size) have changed since it was last built
+        vp = self.viewport
+        pb = self.pixel_buffer
+        key = (vp, vp.x_min, vp.y_min, vp.width, vp.height, pb, pb.width, pb.height)
+        if key != self.transform_key:
+            self.cached_transform = Transform(vp, pb)
+            self.transform_key = key
+        return self.cached_transform
+
+    def paint(self, obj):
+        if self.cache is None:
             obj.render(self)
-        return self.pixel_buffer.render()
+        else:
+            self.cache.paint(obj, self)
+
+    def render(self, seed = 0, compat = False):
+        return ''.join(self.render_rows(seed, compat))
+
+    def render_rows(self, seed = 0, compat = False):
+        self.refresh()
+        return self.pixel_buffer.render_rows(seed, compat)
+
+    def render_into(self, out = None, seed = 0, compat = False):
+        # the frame as bytes, see PixelBuffer.render_into
+        self.refresh()
+        return self.pixel_buffer.render_into(out, seed, compat)
+
+    def render_tiled(self, seed = 0, compat = False, tile = 256, workers = None):
+        return ''.join(self.render_tiled_rows(seed, compat, tile, workers))
+
+    def render_tiled_rows(self, seed = 0, compat = False, tile = 256, workers = None):
+        # renders the scene from scratch (leaving the retained pixel buffer alone) as tile x tile squares
+        # rasterized and resolved in a pool of worker processes, for pictures big enough that one core is
+        # the bottleneck. objects are binned into the tiles their screen rectangles touch and shipped to
+        # each worker once, and every tile draws the same random numbers its pixels get in a serial
+        # render, so the picture is the same as render() gives for the seed. compat works too, but every
+        # tile has to step the random module past the pixels before it
+        pb = self.pixel_buffer
+        columns = math.ceil(pb.width / tile)
+        bands = math.ceil(pb.height / tile)
+        bins = [[] for _ in range(columns * bands)]
+        for i, obj in enumerate(self.objects):
+            box = self.screen_box(obj)
+            if box is None:
+                continue
+            for band in range(box[1] // tile, box[3] // tile + 1):
+                for column in range(box[0] // tile, box[2] // tile + 1):
+                    bins[band * columns + column].append(i)
+
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=load_tile_scene, initargs=(self.objects, self.viewport, pb.width, pb.height, pb.background_material)) as executor:
+            futures = []
+            for band in range(bands):
+                futures.append([])
+                for column in range(columns):
+                    area = (column * tile, band * tile, min((column + 1) * tile, pb.width) - 1, min((band + 1) * tile, pb.height) - 1)
+                    futures[-1].append(executor.submit(render_tile, area, bins[band * columns + column], seed, compat))
+            # stitch each band of tiles back into whole rows as soon as it is done
+            for band in futures:
+                for pieces in zip(*[future.result() for future in band]):
+                    yield ''.join(pieces) + '\n'
+
+    def render_diff(self, seed = 0, compat = False):
+        # ansi escapes that turn the frame written by the previous render_diff into the current one by
+        # only rewriting the cells that changed, the first frame (or one of another size) is drawn in full
+        # from the top left corner. the cursor is left on the line below the frame
+        rows = list(self.render_rows(seed, compat))
+        old = self.frame
+        self.frame = rows
+        if old is None or len(old) != len(rows) or any(len(a) != len(b) for a, b in zip(old, rows)):
+            return '\x1b[H\x1b[J' + ''.join(rows)
+
+        out = []
+        for y, (before, after) in enumerate(zip(old, rows)):
+            if before == after:
+                continue
+            # runs of changed cells (two characters each), joining runs with short gaps between them
+            # since a cursor move costs about as much as rewriting four cells
+            changed = [x for x in range(0, len(after) - 1, 2) if before[x] != after[x]]
+            start = end = changed[0]
+            for x in changed[1:] + [None]:
+                if x is not None and x - end <= 8:
+                    end = x
+                    continue
+                out.append('\x1b[%d;%dH%s' % (y + 1, start + 1, after[start:end + 1]))
+                if x is not None:
+                    start = end = x
+        out.append('\x1b[%d;1H' % (len(rows) + 1))
+        return ''.join(out)
+
+# the objects, viewport and picture a tile worker renders from, shipped to each worker once by load_tile_scene
+tile_scene = None
+
+def load_tile_scene(objects, viewport, width, height, background):
+    global tile_scene
+    tile_scene = (objects, viewport, width, height, background)
+
+def render_tile(area, indices, seed, compat):
+    # rasterizes and resolves one tile of the picture from the objects at indices, returns its rows without newlines
+    objects, viewport, width, height, background = tile_scene
+    scene = Scene([objects[i] for i in indices], viewport, PixelBuffer(width, height, background, area))
+    return [row[:-1] for row in scene.render_rows(seed, compat)]
 
 class Material():
     def list_to_mat(l, priority = 0):
@@ -97,6 +749,32 @@ class Renderable():
     def render(self, scene):
         pass
 
+    def bounds(self, scene):
+        # the (x0, y0, x1, y1) pixel rectangle, corners included, that render can paint in, or None if
+        # it paints nothing. the whole buffer unless a subclass knows better
+        return (0, 0, scene.pixel_buffer.width - 1, scene.pixel_buffer.height - 1)
+
+    def raster_key(self):
+        # a hashable description of everything render depends on apart from the transform (geometry and
+        # materials), for a RasterCache to recognise it by. None if it can't be cached
+        return None
+
+def material_key(mat):
+    # what a material (or list of them, or None) rasterizes the same as
+    if mat is None:
+        return None
+    if type(mat) is list:
+        return tuple([material_key(m) for m in mat])
+    return (mat.char, mat.priority, mat.mix)
+
+def points_bounds(points):
+    # the rectangle around a list of (x, y) pixel points
+    if not points:
+        return None
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
 class Circle(Renderable):
     def __init__(self, x, y, radius, edge_mat, fill_mat = None):
         self.x = x
@@ -105,43 +783,52 @@ class Circle(Renderable):
         self.edge_mat = edge_mat
         self.fill_mat = fill_mat
 
+    def raster_key(self):
+        return ('circle', self.x, self.y, self.radius, material_key(self.edge_mat), material_key(self.fill_mat))
+
+    def bounds(self, scene):
+        x, y = scene.transform.point(self.x, self.y)
+        radius = abs(scene.transform.length(self.radius))
+        return (x - radius, y - radius, x + radius, y + radius)
+
     def render(self, scene):
-        vp = scene.viewport
         pb = scene.pixel_buffer
+        transform = scene.transform
         # draw a circle into the pixel buffer
-        # transform the circle's center point from world coordinates to viewport coordinates then to pixel buffer coordinates
-        x, y = pb.viewport_to_buffer(*vp.world_to_viewport(self.x, self.y))
-        # transform the circle's radius from world coordinates to viewport coordinates
-        radius = pb.viewport_to_buffer(*vp.world_to_viewport(self.radius, 0))[0] - pb.viewport_to_buffer(0, 0)[0]
+        # transform the circle's center point from world coordinates to pixel buffer coordinates
+        x, y = transform.point(self.x, self.y)
+        # transform the circle's radius from world coordinates to pixels
+        radius = transform.length(self.radius)
         # test if the circle is completely outside the pixel buffer
         if x + radius < 0 or x - radius >= pb.width or y + radius < 0 or y - radius >= pb.height:
-            return false
+            return False
         # use the midpoint circle algorithm to draw the circle
         # https://en.wikipedia.org/wiki/Midpoint_circle_algorithm
         x0 = radius
         y0 = 0
         radius_error = 1 - x0
+        points = []
         while x0 >= y0:
             # draw the circle's 8 octants
             for i in [-1, 1]:
                 for j in [-1, 1]:
-                    pb.paint_pixel(x + i * x0, y + j * y0, self.edge_mat)
-                    pb.paint_pixel(x + i * y0, y + j * x0, self.edge_mat)
+                    points.append((x + i * x0, y + j * y0))
+                    points.append((x + i * y0, y + j * x0))
             y0 += 1
             if radius_error < 0:
                 radius_error += 2 * y0 + 1
             else:
                 x0 -= 1
                 radius_error += 2 * (y0 - x0 + 1)
+        pb.paint_points(points, self.edge_mat)
 
         # fill the circle if a fill material was provided
+        # one span per row, covering the offsets from -radius up to radius - 1 that are within the radius
         if self.fill_mat is not None:
-            for xp in range(-radius,radius):
-                for yp in range(-radius,radius):
-                    if xp * xp + yp * yp <= radius * radius:
-                        xf = xp + x
-                        yf = yp + y
-                        pb.paint_pixel(xf, yf, self.fill_mat)
+            window = pb.window()
+            for yp in range(max(-radius, window[1] - y), min(radius, window[3] - y + 1)):
+                half = math.isqrt(radius * radius - yp * yp)
+                pb.paint_span(y + yp, x - half, x + min(half, radius - 1), self.fill_mat)
         return True
 
 
@@ -154,36 +841,19 @@ class Line(Renderable):
         self.y2 = y2
         self.mat = mat
 
-    def render(self, scene):
-        vp = scene.viewport
-        pb = scene.pixel_buffer
+    def raster_key(self):
+        return ('line', self.x1, self.y1, self.x2, self.y2, material_key(self.mat))
 
-        # transform the line's endpoints from world coordinates to viewport coordinates then to pixel buffer coordinates
-        x1, y1 = pb.viewport_to_buffer(*vp.world_to_viewport(self.x1, self.y1))
-        x2, y2 = pb.viewport_to_buffer(*vp.world_to_viewport(self.x2, self.y2))
+    def bounds(self, scene):
+        return points_bounds([scene.transform.point(self.x1, self.y1), scene.transform.point(self.x2, self.y2)])
 
-        # test if the line is completely outside the pixel buffer
-        if x1 < 0 and x2 < 0 or x1 >= pb.width and x2 >= pb.width or y1 < 0 and y2 < 0 or y1 >= pb.height and y2 >= pb.height:
-            return False
+    def render(self, scene):
+        transform = scene.transform
 
-        dx = abs(x2 - x1)
-        sx = 1 if x1 < x2 else -1
-        dy = -abs(y2 - y1)
-        sy = 1 if y1 < y2 else -1
-        err = dx + dy
-
-        #modified bidirectional bresenham's line algorithm
-        while True:
-            pb.paint_pixel(x1, y1, self.mat)
-            if x1 == x2 and y1 == y2:
-                break
-            e2 = 2 * err
-            if e2 >= dy:
-                err += dy
-                x1 += sx
-            if e2 <= dx:
-                err += dx
-                y1 += sy
+        # transform the line's endpoints from world coordinates to pixel buffer coordinates
+        x1, y1 = transform.point(self.x1, self.y1)
+        x2, y2 = transform.point(self.x2, self.y2)
+        return stroke_line(scene.pixel_buffer, x1, y1, x2, y2, self.mat)
 
 
 class Triangle(Renderable):
@@ -198,54 +868,17 @@ class Triangle(Renderable):
         self.edge_mat = edge_mat
         self.fill_mat = fill_mat
 
-    def render(self, scene):
-        # transform the triangle's endpoints from world coordinates to viewport coordinates then to pixel buffer coordinates
-        vp = scene.viewport
-        pb = scene.pixel_buffer
-
-        x1, y1 = pb.viewport_to_buffer(*vp.world_to_viewport(self.x1, self.y1))
-        x2, y2 = pb.viewport_to_buffer(*vp.world_to_viewport(self.x2, self.y2))
-        x3, y3 = pb.viewport_to_buffer(*vp.world_to_viewport(self.x3, self.y3))
+    def raster_key(self):
+        return ('triangle', self.x1, self.y1, self.x2, self.y2, self.x3, self.y3, material_key(self.edge_mat), material_key(self.fill_mat))
 
-        # test if the triangle is completely outside the pixel buffer
-        if x1 < 0 and x2 < 0 and x3 < 0 or x1 >= pb.width and x2 >= pb.width and x3 >= pb.width or y1 < 0 and y2 < 0 and y3 < 0 or y1 >= pb.height and y2 >= pb.height and y3 >= pb.height:
-            return False
+    def bounds(self, scene):
+        return points_bounds([scene.transform.point(x, y) for x, y in ((self.x1, self.y1), (self.x2, self.y2), (self.x3, self.y3))])
 
-        # use the baricentric algorithm to draw the triangle
-        # https://en.wikipedia.org/wiki/Barycentric_coordinate_system
-
-        # compute the bounding box of the triangle
-        x_min = min(x1, x2, x3)
-        x_max = max(x1, x2, x3)
-        y_min = min(y1, y2, y3)
-        y_max = max(y1, y2, y3)
-
-        # subfunction to test if a point is inside the triangle
-        def inside(x, y):
-            # compute the barycentric coordinates of the point
-            # but first test if the triangle is degenerate
-            area = (y2 - y3) * (x1 - x3) + (x3 - x2) * (y1 - y3)
-            if area == 0:
-                return False
-            alpha = ((y2 - y3) * (x - x3) + (x3 - x2) * (y - y3)) / area
-            beta = ((y3 - y1) * (x - x3) + (x1 - x3) * (y - y3)) / area
-            gamma = 1 - alpha - beta
-            # test if the point is inside the triangle
-            return alpha >= 0 and beta >= 0 and gamma >= 0
-
-
-        # draw the edges of the triangle as lines (using world coordinates)
-        Line(self.x1, self.y1, self.x2, self.y2, self.edge_mat).render(scene)
-        Line(self.x2, self.y2, self.x3, self.y3, self.edge_mat).render(scene)
-        Line(self.x3, self.y3, self.x1, self.y1, self.edge_mat).render(scene)
-
-        # fill the triangle if a fill material was provided
-        if self.fill_mat is not None:
-            for x in range(x_min, x_max):
-                for y in range(y_min, y_max):
-                    if inside(x, y):
-                        pb.paint_pixel(x, y, self.fill_mat)
-        return True
+    def render(self, scene):
+        # transform the triangle's endpoints from world coordinates to pixel buffer coordinates
+        transform = scene.transform
+        points = [transform.point(self.x1, self.y1), transform.point(self.x2, self.y2), transform.point(self.x3, self.y3)]
+        return render_polygon(scene.pixel_buffer, points, self.edge_mat, self.fill_mat)
 
 class Polygon(Renderable):
 
@@ -254,30 +887,89 @@ class Polygon(Renderable):
         self.edge_mat = edge_mat
         self.fill_mat = fill_mat
 
-    def render(self, scene):
+    def raster_key(self):
+        return ('polygon', tuple([(float(x), float(y)) for x, y in self.points]), material_key(self.edge_mat), material_key(self.fill_mat))
 
-        vp = scene.viewport
-        pb = scene.pixel_buffer
-
-        # transform the polygon's points from world coordinates to viewport coordinates then to pixel buffer coordinates
-        world_coords = self.points
-        points = [pb.viewport_to_buffer(*vp.world_to_viewport(x, y)) for x, y in self.points]
-
-        # test if the polygon is completely outside the pixel buffer
-        if all(x < 0 for x, y in points) or all(x >= pb.width for x, y in points) or all(y < 0 for x, y in points) or all(y >= pb.height for x, y in points):
-            return False
-
-        #break the polygon into triangles (using world coordinates)
-        triangles = []
-        for i in range(1, len(points) - 1):
-            triangles.append((world_coords[0], world_coords[i], world_coords[i + 1]))
-
-        # draw the edges of the polygon as lines (using world coordinates)
-        for i in range(len(points)):
-            Line(self.points[i][0], self.points[i][1], self.points[(i + 1) % len(points)][0], self.points[(i + 1) % len(points)][1], self.edge_mat).render(scene)
-
-        # fill the polygon if a fill material was provided
-        if self.fill_mat is not None:
-            for t in triangles:
-                Triangle(t[0][0], t[0][1], t[1][0], t[1][1], t[2][0], t[2][1], [], self.fill_mat).render(scene)
+    def bounds(self, scene):
+        return points_bounds(scene.transform.points(self.points))
 
+    def render(self, scene):
+        # transform the polygon's points from world coordinates to pixel buffer coordinates, all at once
+        points = scene.transform.points(self.points)
+        return render_polygon(scene.pixel_buffer, points, self.edge_mat, self.fill_mat)
+
+
+def render_polygon(pb, points, edge_mat, fill_mat = None):
+    # strokes and (if a fill material is given) fills a polygon given in pixel buffer coordinates
+    # test if the polygon is completely outside the pixel buffer
+    if all(x < 0 for x, y in points) or all(x >= pb.width for x, y in points) or all(y < 0 for x, y in points) or all(y >= pb.height for x, y in points):
+        return False
+
+    # draw the edges of the polygon as lines
+    for i in range(len(points)):
+        stroke_line(pb, *points[i], *points[(i + 1) % len(points)], edge_mat)
+
+    if fill_mat is not None:
+        scanline_fill(pb, points, fill_mat)
+    return True
+
+def stroke_line(pb, x1, y1, x2, y2, mat):
+    # draws a line between two points in pixel buffer coordinates
+
+    # test if the line is completely outside the pixel buffer
+    if x1 < 0 and x2 < 0 or x1 >= pb.width and x2 >= pb.width or y1 < 0 and y2 < 0 or y1 >= pb.height and y2 >= pb.height:
+        return False
+
+    dx = abs(x2 - x1)
+    sx = 1 if x1 < x2 else -1
+    dy = -abs(y2 - y1)
+    sy = 1 if y1 < y2 else -1
+    err = dx + dy
+
+    #modified bidirectional bresenham's line algorithm
+    points = []
+    while True:
+        points.append((x1, y1))
+        if x1 == x2 and y1 == y2:
+            break
+        e2 = 2 * err
+        if e2 >= dy:
+            err += dy
+            x1 += sx
+        if e2 <= dx:
+            err += dx
+            y1 += sy
+    pb.paint_points(points, mat)
+    return True
+
+def scanline_fill(pb, points, mat):
+    # even-odd scanline fill of a polygon given in pixel buffer coordinates, works for concave and
+    # self intersecting polygons alike. edges go into an edge table sorted by their top row and sit in
+    # the active edge table while the scanline crosses them (top row included, bottom row not), and
+    # each row is painted as spans between pairs of crossings, pixels exactly on an edge included
+    edges = []
+    for i in range(len(points)):
+        (x0, y0), (x1, y1) = points[i], points[(i + 1) % len(points)]
+        if y0 == y1:
+            continue
+        if y0 > y1:
+            x0, y0, x1, y1 = x1, y1, x0, y0
+        edges.append((y0, y1, x0, (x1 - x0) / (y1 - y0)))
+    if not edges:
+        return
+    edges.sort()
+
+    active = []
+    next_edge = 0
+    window = pb.window()
+    for y in range(max(math.ceil(edges[0][0]), window[1]), min(math.ceil(max(edge[1] for edge in edges)), window[3] + 1)):
+        while next_edge < len(edges) and edges[next_edge][0] <= y:
+            active.append(edges[next_edge])
+            next_edge += 1
+        active = [edge for edge in active if edge[1] > y]
+        crossings = sorted(x0 + (y - y0) * slope for y0, y1, x0, slope in active)
+        for left, right in zip(crossings[::2], crossings[1::2]):
+            # a zero width span is the polygon folding back on itself (eg. a two point polygon), not area
+            if right <= left:
+                continue
+            pb.paint_span(y, math.ceil(left), math.floor(right), mat)
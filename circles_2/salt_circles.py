@@ -1,107 +1,555 @@
+import math
 import random
 from render import *
-from vector import V
+from vector import V, VArray
 import time
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def as_points(points):
+    # a batch of points (a VArray, a list of V or an n x 2 array) as a VArray
+    if isinstance(points, VArray):
+        return points
+    points = list(points)
+    if points and isinstance(points[0], V):
+        return VArray.from_points(points)
+    return VArray(points)
+
 class Structure:
+    broad_phase = None #the SweepAndPrune the structure is in, told about moves and shape changes
+
     def __init__(self, location):
         self.location = location
+        self.sdf = None
+        self.sdf_settings = None
 
     def tangent_vector(self, point):
-        #vector to edge from point
-        return V(0,0)
+        #vector to edge from point, from the sdf cache when there is one that covers the point
+        sdf = self.cached_sdf()
+        if sdf is not None:
+            tangent = sdf.tangent_vector(point - self.location)
+            if tangent is not None:
+                return tangent
+        return self.exact_tangent_vector(point)
+
+    def tangent_vectors(self, points):
+        #tangent_vector for a whole batch of points, as a VArray (a list of V without numpy)
+        if np is None:
+            return [self.tangent_vector(point) for point in points]
+        sdf = self.cached_sdf()
+        if sdf is None:
+            return self.exact_tangent_vectors(points)
+        points = as_points(points)
+        tangents, exact = sdf.tangent_vectors(points - self.location)
+        if exact.any():
+            tangents.xy[exact] = self.exact_tangent_vectors(points[exact]).xy
+        return tangents
+
+    @classmethod
+    def tangent_vectors_of(cls, structures, points):
+        #the tangent vector from each point (a row of an n x 2 array) to the structure at the same index,
+        #all of them of this class. structures with an sdf cache are asked one at a time, the rest in one
+        #exact_tangent_vectors_of pass
+        cached = [i for i, structure in enumerate(structures) if structure.sdf_settings is not None]
+        if not cached:
+            return cls.exact_tangent_vectors_of(structures, points)
+        tangents = np.empty_like(points)
+        groups = {}
+        for i in cached:
+            groups.setdefault(id(structures[i]), (structures[i], []))[1].append(i)
+        for structure, index in groups.values():
+            tangents[index] = structure.tangent_vectors(VArray(points[index])).xy
+        exact = np.ones(len(structures), dtype=bool)
+        exact[cached] = False
+        if exact.any():
+            index = np.flatnonzero(exact)
+            tangents[index] = cls.exact_tangent_vectors_of([structures[i] for i in index], points[index])
+        return tangents
+
+    @classmethod
+    def exact_tangent_vectors_of(cls, structures, points):
+        #exact_tangent_vectors for each point against the structure at the same index, subclasses with a
+        #closed form do them all in one pass
+        groups = {}
+        for i, structure in enumerate(structures):
+            groups.setdefault(id(structure), (structure, []))[1].append(i)
+        tangents = np.empty_like(points)
+        for structure, index in groups.values():
+            tangents[index] = structure.exact_tangent_vectors(VArray(points[index])).xy
+        return tangents
 
     def distance_to(self, point):
         #distance to edge from point
-        return self.tangent_vector(point).norm()
+        sdf = self.cached_sdf()
+        if sdf is not None:
+            distance = sdf.distance(point - self.location)
+            if distance is not None:
+                return distance
+        return self.exact_tangent_vector(point).norm()
+
+    def exact_tangent_vector(self, point):
+        return V(0,0)
+
+    def exact_tangent_vectors(self, points):
+        return VArray.from_points([self.exact_tangent_vector(point) for point in as_points(points)])
+
+    def contains_points(self, points):
+        #whether each point is inside the structure, as a boolean array (structures without an inside never contain anything)
+        return np.zeros(len(as_points(points)), dtype=bool)
+
+    def extent(self):
+        #(x_min, y_min, x_max, y_max) of the structure relative to its location
+        return (0, 0, 0, 0)
+
+    def cache_sdf(self, spacing = 0.25, margin = 5, tolerance = 0.05):
+        #answer tangent_vector and distance_to from a sampled signed distance field (see SDF), built on the
+        #next query and kept across moves, tolerance=None keeps every cell however big its error
+        if np is None:
+            raise ImportError("the sdf cache needs numpy")
+        self.sdf_settings = (spacing, margin, tolerance)
+        self.sdf = None
+
+    def uncache_sdf(self):
+        self.sdf_settings = None
+        self.sdf = None
+
+    def cached_sdf(self):
+        if self.sdf is None and self.sdf_settings is not None:
+            self.sdf = SDF(self, *self.sdf_settings)
+        return self.sdf
+
+    def shape_changed(self):
+        #the shape itself (not just its location) changed, so a cached sdf is stale
+        self.sdf = None
+        if self.broad_phase is not None:
+            self.broad_phase.moved(self)
 
     def move(self, vector):
-        self.location += vector
+        # a new vector rather than +=, the location may be shared with whoever made the structure
+        self.location = self.location + vector
+        if self.broad_phase is not None:
+            self.broad_phase.moved(self)
 
     def render_in(self, scene):
         pass
         #make the relevant graphics primitives and add them to the scene
 
+    def update_in(self, scene):
+        pass
+        #move the graphics primitives made by render_in to where the structure is now and have the scene redraw them
+
 
 class CircleS(Structure):
     def __init__(self, location, radius):
         super().__init__(location)
         self.radius = radius
 
+    @property
+    def radius(self):
+        return self._radius
+
+    @radius.setter
+    def radius(self, radius):
+        self._radius = radius
+        self.shape_changed()
+
+    def extent(self):
+        return (-self.radius, -self.radius, self.radius, self.radius)
+
+    def contains_points(self, points):
+        offsets = (as_points(points) - self.location).xy
+        return np.float_power(offsets[:, 0], 2) + np.float_power(offsets[:, 1], 2) < self.radius**2
+
     def render_in(self, scene, material, fill_material=None):
-        circle = Circle(self.location.x, self.location.y, self.radius, material, fill_material)
-        scene.objects.append(circle)
+        self.graphic = Circle(self.location.x, self.location.y, self.radius, material, fill_material)
+        scene.add(self.graphic)
 
-    def tangent_vector(self, point):
+    def update_in(self, scene):
+        self.graphic.x = self.location.x
+        self.graphic.y = self.location.y
+        self.graphic.radius = self.radius
+        scene.update(self.graphic)
+
+    def exact_tangent_vector(self, point):
         naive = self.location - point
         length = naive.norm()
         if length == 0:
             return V(self.radius, 0)
         return naive.normalized()*(length-self.radius)
 
-    def distance_to(self, point):
-        return self.tangent_vector(point).norm()
+    def exact_tangent_vectors(self, points):
+        naive = (-as_points(points) + self.location).xy
+        length = np.sqrt(np.float_power(naive[:, 0], 2) + np.float_power(naive[:, 1], 2))
+        centered = length == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tangents = naive / length[:, np.newaxis] * (length - self.radius)[:, np.newaxis]
+        tangents[centered] = (self.radius, 0)
+        return VArray(tangents)
+
+    @classmethod
+    def exact_tangent_vectors_of(cls, structures, points):
+        #over every circle's location and radius at once
+        centers = np.array([(structure.location.x, structure.location.y) for structure in structures], dtype=float).reshape(-1, 2)
+        radii = np.array([structure.radius for structure in structures], dtype=float)
+        naive = centers - points
+        length = np.sqrt(np.float_power(naive[:, 0], 2) + np.float_power(naive[:, 1], 2))
+        centered = length == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tangents = naive / length[:, np.newaxis] * (length - radii)[:, np.newaxis]
+        tangents[centered, 0] = radii[centered]
+        tangents[centered, 1] = 0
+        return tangents
+
+class Edges:
+    # the edges of a chain of points (closed into a loop or not) as cached (start, end, direction, length)
+    # tuples, with the direction pointing from an edge's end back to its start, plus the same in arrays
+    # for batched queries, built the first time they are needed.
+    # a move only shifts the end points, directions and lengths don't change under translation
+    def __init__(self, points, closed):
+        count = len(points) if closed else len(points) - 1
+        self.edges = []
+        for i in range(count):
+            start, end = points[i], points[(i+1)%len(points)]
+            line_vector = start - end
+            length = line_vector.norm()
+            self.edges.append((start, end, line_vector / length if length else V(0, 0), length))
+        self.arrays = None
+
+    def move(self, vector):
+        self.edges = [(start + vector, end + vector, direction, length) for start, end, direction, length in self.edges]
+        if self.arrays is not None:
+            self.arrays[0].xy += vector.x, vector.y
+            self.arrays[1].xy += vector.x, vector.y
+
+    def tangent_vector(self, point):
+        #vector from point to the closest point of the closest edge, the first edge wins ties
+        final = None
+        final_norm = float("inf")
+        for start, end, direction, length in self.edges:
+            point_vector = start - point
+            projection = point_vector * direction
+            if projection < 0:
+                tangent = point_vector
+            elif projection > length:
+                tangent = end - point
+            else:
+                tangent = point_vector - direction*projection
+            norm = tangent.norm_squared()
+            if final is None or norm < final_norm:
+                final, final_norm = tangent, norm
+        return final
+
+    def edge_arrays(self):
+        if self.arrays is None:
+            self.arrays = tuple([VArray.from_points([edge[i] for edge in self.edges]) for i in range(3)]) + (np.array([edge[3] for edge in self.edges]),)
+        return self.arrays
+
+    def tangent_vectors(self, points):
+        #tangent_vector for every point at once: every point against every edge in one pass, then the
+        #closest edge per point
+        starts, ends, directions, lengths = self.edge_arrays()
+        points = as_points(points).xy[:, np.newaxis, :]
+        return VArray(closest_tangents(points, starts.xy[np.newaxis], ends.xy[np.newaxis], directions.xy[np.newaxis], lengths[np.newaxis]))
+
+    @staticmethod
+    def tangent_vectors_of(edge_sets, points):
+        #the tangent vector from each point (a row of an n x 2 array) to the Edges at the same index. the
+        #edge sets are padded to the longest by repeating their last edge, which can't change the closest one
+        count = max([len(edges.edges) for edges in edge_sets])
+        padded = [np.empty((len(edge_sets), count, 2)) for _ in range(3)] + [np.empty((len(edge_sets), count))]
+        for i, edges in enumerate(edge_sets):
+            n = len(edges.edges)
+            for array, padding in zip(edges.edge_arrays(), padded):
+                values = array.xy if isinstance(array, VArray) else array
+                padding[i, :n] = values
+                padding[i, n:] = values[-1]
+        return closest_tangents(points[:, np.newaxis, :], *padded)
+
+def closest_tangents(points, starts, ends, directions, lengths):
+    #points is n x 1 x 2, the edges n x m (x 2) or 1 x m (x 2). the vector from each point to the closest
+    #point of each edge, then the closest edge per point, the first edge wins ties
+    point_vectors = starts - points
+    projections = point_vectors[:, :, 0] * directions[:, :, 0] + point_vectors[:, :, 1] * directions[:, :, 1]
+    tangents = np.where((projections < 0)[:, :, np.newaxis], point_vectors,
+        np.where((projections > lengths)[:, :, np.newaxis], ends - points,
+        point_vectors - directions * projections[:, :, np.newaxis]))
+    closest = np.argmin(np.float_power(tangents[:, :, 0], 2) + np.float_power(tangents[:, :, 1], 2), axis=1)
+    return tangents[np.arange(len(tangents)), closest]
+
+class SDF:
+    # signed distance (negative inside) and its gradient sampled every spacing on a grid covering a
+    # structure plus margin, in the structure's own frame: positions are relative to its location, which
+    # moves with it, so a move doesn't touch the grid and only a change of shape throws it away.
+    # lookups interpolate distance and gradient bilinearly and turn them back into a tangent vector
+    # (-distance * the normalized gradient). when the grid is built that is compared with the exact
+    # answer at the center and edge midpoints of every cell: cells where it is off by more than tolerance
+    # (where the closest edge jumps, like along a polygon's medial axis or across a line) are answered
+    # exactly instead, and error is the largest difference measured in the others. points off the grid
+    # are answered exactly too
+    def __init__(self, structure, spacing = 0.25, margin = 5, tolerance = 0.05):
+        x_min, y_min, x_max, y_max = structure.extent()
+        self.spacing = spacing
+        self.x_min = x_min - margin
+        self.y_min = y_min - margin
+        self.columns = max(1, math.ceil((x_max + margin - self.x_min) / spacing))
+        self.rows = max(1, math.ceil((y_max + margin - self.y_min) / spacing))
+
+        # samples at the grid nodes
+        xs = self.x_min + np.arange(self.columns + 1) * spacing
+        ys = self.y_min + np.arange(self.rows + 1) * spacing
+        nodes = VArray(np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2))
+        tangents = structure.exact_tangent_vectors(nodes + structure.location).xy
+        distance = np.sqrt(np.float_power(tangents[:, 0], 2) + np.float_power(tangents[:, 1], 2))
+        sign = np.where(structure.contains_points(nodes + structure.location), -1.0, 1.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            gradient = np.where(distance[:, np.newaxis] > 0, -sign[:, np.newaxis] * tangents / distance[:, np.newaxis], 0.0)
+        shape = (self.rows + 1, self.columns + 1)
+        self.signed = (sign * distance).reshape(shape)
+        self.gradient_x = gradient[:, 0].reshape(shape)
+        self.gradient_y = gradient[:, 1].reshape(shape)
+
+        # the error measured at every half step, each cell takes the worst of its center and edge midpoints
+        self.exact = np.zeros((self.rows, self.columns), dtype=bool)
+        hxs = self.x_min + np.arange(2 * self.columns + 1) * spacing / 2
+        hys = self.y_min + np.arange(2 * self.rows + 1) * spacing / 2
+        half = VArray(np.stack(np.meshgrid(hxs, hys), axis=-1).reshape(-1, 2))
+        approximate, _ = self.tangent_vectors(half)
+        error = (approximate - structure.exact_tangent_vectors(half + structure.location)).norm()
+        error = np.where(np.isnan(error), np.inf, error).reshape(2 * self.rows + 1, 2 * self.columns + 1)
+        cell_error = np.maximum.reduce([error[1::2, 1::2], error[0:-1:2, 1::2], error[2::2, 1::2], error[1::2, 0:-1:2], error[1::2, 2::2]])
+        if tolerance is not None:
+            self.exact = cell_error > tolerance
+        kept = cell_error[~self.exact]
+        self.error = float(kept.max()) if len(kept) else 0.0
+
+        # plain lists for single point lookups, indexing them is much cheaper than indexing arrays
+        self.signed_rows = self.signed.tolist()
+        self.gradient_x_rows = self.gradient_x.tolist()
+        self.gradient_y_rows = self.gradient_y.tolist()
+        self.exact_rows = self.exact.tolist()
+
+    def cell(self, local):
+        #(column, row, fraction across, fraction down) of the cell a local point is in, None when it is
+        #off the grid or in a cell that is answered exactly
+        fx = (local.x - self.x_min) / self.spacing
+        fy = (local.y - self.y_min) / self.spacing
+        column = math.floor(fx)
+        row = math.floor(fy)
+        if column < 0 or column >= self.columns or row < 0 or row >= self.rows or self.exact_rows[row][column]:
+            return None
+        return column, row, fx - column, fy - row
+
+    def interpolate(self, rows, column, row, tx, ty):
+        top = rows[row][column] * (1 - tx) + rows[row][column + 1] * tx
+        bottom = rows[row + 1][column] * (1 - tx) + rows[row + 1][column + 1] * tx
+        return top * (1 - ty) + bottom * ty
+
+    def distance(self, local):
+        #unsigned distance to the edge from a point in the structure's frame, None if it has to be done exactly
+        cell = self.cell(local)
+        if cell is None:
+            return None
+        return abs(self.interpolate(self.signed_rows, *cell))
+
+    def tangent_vector(self, local):
+        #vector to the edge from a point in the structure's frame, None if it has to be done exactly
+        cell = self.cell(local)
+        if cell is None:
+            return None
+        distance = self.interpolate(self.signed_rows, *cell)
+        gx = self.interpolate(self.gradient_x_rows, *cell)
+        gy = self.interpolate(self.gradient_y_rows, *cell)
+        norm = math.sqrt(gx**2 + gy**2)
+        if norm == 0:
+            return None
+        return V(-distance * gx / norm, -distance * gy / norm)
+
+    def tangent_vectors(self, local):
+        #tangent_vector for a VArray of points in the structure's frame at once, returns the tangents
+        #and a mask of the points that have to be done exactly (their tangents are left as nan)
+        fx = (local.x - self.x_min) / self.spacing
+        fy = (local.y - self.y_min) / self.spacing
+        columns = np.floor(fx).astype(int)
+        rows = np.floor(fy).astype(int)
+        on_grid = (columns >= 0) & (columns < self.columns) & (rows >= 0) & (rows < self.rows)
+        columns = np.clip(columns, 0, self.columns - 1)
+        rows = np.clip(rows, 0, self.rows - 1)
+        tx = fx - columns
+        ty = fy - rows
+        def interpolate(grid):
+            top = grid[rows, columns] * (1 - tx) + grid[rows, columns + 1] * tx
+            bottom = grid[rows + 1, columns] * (1 - tx) + grid[rows + 1, columns + 1] * tx
+            return top * (1 - ty) + bottom * ty
+        distance = interpolate(self.signed)
+        gradient = np.stack((interpolate(self.gradient_x), interpolate(self.gradient_y)), axis=1)
+        norm = np.sqrt(np.float_power(gradient[:, 0], 2) + np.float_power(gradient[:, 1], 2))
+        exact = ~on_grid | self.exact[rows, columns] | (norm == 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tangents = -distance[:, np.newaxis] * gradient / norm[:, np.newaxis]
+        tangents[exact] = np.nan
+        return VArray(tangents), exact
 
 class LineS(Structure):
     def __init__(self, start, end):
-        self.start = start
-        self.end = end
+        self._start = start
+        self._end = end
+        self.edges = Edges([start, end], closed=False)
         super().__init__((start+end)/2)
 
+    @property
+    def start(self):
+        return self._start
+
+    @start.setter
+    def start(self, start):
+        # a new shape, so the edge is worked out again
+        self._start = start
+        self.edges = Edges([self._start, self._end], closed=False)
+        self.shape_changed()
+
+    @property
+    def end(self):
+        return self._end
+
+    @end.setter
+    def end(self, end):
+        self._end = end
+        self.edges = Edges([self._start, self._end], closed=False)
+        self.shape_changed()
+
     def render_in(self, scene, material):
-        line = Line(self.start.x, self.start.y, self.end.x, self.end.y, material)
-        scene.objects.append(line)
+        self.graphic = Line(self.start.x, self.start.y, self.end.x, self.end.y, material)
+        scene.add(self.graphic)
+
+    def update_in(self, scene):
+        self.graphic.x1, self.graphic.y1 = self.start.x, self.start.y
+        self.graphic.x2, self.graphic.y2 = self.end.x, self.end.y
+        scene.update(self.graphic)
 
     def move(self, vector):
-        self.start += vector
-        self.end += vector
-        super.move(vector)
+        # new vectors rather than +=, the end points may be shared with whoever made the line. a move
+        # doesn't change the shape, so the edges are shifted rather than worked out again
+        self._start = self.start + vector
+        self._end = self.end + vector
+        self.edges.move(vector)
+        super().move(vector)
 
-    def tangent_vector(self, point):
+    def extent(self):
+        return (min(self.start.x, self.end.x) - self.location.x, min(self.start.y, self.end.y) - self.location.y,
+            max(self.start.x, self.end.x) - self.location.x, max(self.start.y, self.end.y) - self.location.y)
+
+    def exact_tangent_vector(self, point):
         #vector to edge from point
-        line_vector = self.start - self.end
-        point_vector = self.start - point
-        projection = point_vector * line_vector.normalized()
-        if projection < 0:
-            return point_vector
-        elif projection > line_vector.norm():
-            return self.end - point
-        else:
-            return point_vector - line_vector.normalized()*projection
+        return self.edges.tangent_vector(point)
+
+    def exact_tangent_vectors(self, points):
+        return self.edges.tangent_vectors(points)
+
+    @classmethod
+    def exact_tangent_vectors_of(cls, structures, points):
+        return Edges.tangent_vectors_of([structure.edges for structure in structures], points)
 
 class PolygonS(Structure):
     def __init__(self, points):
         self.points = points
         super().__init__(sum(points)/len(points))
 
+    @property
+    def points(self):
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        # a new shape, so the edges are worked out again
+        self._points = points
+        self.edges = Edges(points, closed=True)
+        self.shape_changed()
+
     def render_in(self, scene, material, fill_material=None):
-        polygon = Polygon([(p.x, p.y) for p in self.points], material, fill_material)
-        scene.objects.append(polygon)
+        self.graphic = Polygon([(p.x, p.y) for p in self.points], material, fill_material)
+        scene.add(self.graphic)
 
-    def tangent_vector(self, point):
-        final = V(float("inf"), float("inf"))
-        for i in range(len(self.points)):
-            line = LineS(self.points[i], self.points[(i+1)%len(self.points)])
-            final = min(final, line.tangent_vector(point))
-        return final
+    def update_in(self, scene):
+        self.graphic.points = [(p.x, p.y) for p in self.points]
+        scene.update(self.graphic)
+
+    def extent(self):
+        return (min([p.x for p in self.points]) - self.location.x, min([p.y for p in self.points]) - self.location.y,
+            max([p.x for p in self.points]) - self.location.x, max([p.y for p in self.points]) - self.location.y)
+
+    def contains_points(self, points):
+        #even-odd rule, counting the edges a ray going right from each point crosses
+        points = as_points(points)
+        inside = np.zeros(len(points), dtype=bool)
+        for start, end, _, _ in self.edges.edges:
+            if start.y == end.y:
+                continue
+            spans = (start.y > points.y) != (end.y > points.y)
+            crossing = start.x + (points.y - start.y) * (end.x - start.x) / (end.y - start.y)
+            inside ^= spans & (points.x < crossing)
+        return inside
+
+    def exact_tangent_vector(self, point):
+        return self.edges.tangent_vector(point)
+
+    def exact_tangent_vectors(self, points):
+        return self.edges.tangent_vectors(points)
+
+    @classmethod
+    def exact_tangent_vectors_of(cls, structures, points):
+        return Edges.tangent_vectors_of([structure.edges for structure in structures], points)
 
     def move(self, vector):
-        self.points = [point + vector for point in self.points]
+        self._points = [point + vector for point in self.points]
+        self.edges.move(vector)
         super().move(vector)
 
-    def distance_to(self, point):
-        return self.tangent_vector(point).norm()
 
+class SolveStats:
+    # what applying a constraint or solving a system did: sweeps over the constraints, the largest
+    # correction in the last sweep, how long it took, whether it reached the tolerance, and how many
+    # contact searches gave up after max_iterations without settling
+    def __init__(self):
+        self.sweeps = 0
+        self.residual = None
+        self.wall_time = 0.0
+        self.converged = False
+        self.unsettled = 0
+
+    def __repr__(self):
+        return(f"<Sweeps: {self.sweeps}, Residual: {self.residual}, Time: {self.wall_time:.3f}s, Converged: {self.converged}, Unsettled: {self.unsettled}>")
 
 class Constraint:
     def __init__(self, objects, priority=1):
         self.objects = objects
 
+    def corrections(self):
+        #the moves, as (structure, vector) pairs, that satisfy the constraint from where everything is now,
+        #the largest violation they correct, and how many contact searches didn't settle
+        return [], 0.0, 0
+
     def apply(self):
-        for obj in self.objects:
-            pass
+        #moves the objects to satisfy the constraint, returns a SolveStats for the one sweep
+        stats = SolveStats()
+        start = time.perf_counter()
+        moves, stats.residual, stats.unsettled = self.corrections()
+        for obj, vector in moves:
+            obj.move(vector)
+        stats.sweeps = 1
+        stats.converged = stats.unsettled == 0
+        stats.wall_time = time.perf_counter() - start
+        return stats
 
 class EdgeConstraint(Constraint):
+    # keeps the children's edges touching the parent's edge. for each child the closest pair of edge
+    # points is found by bouncing between the two edges until a bounce moves less than sensitivity
+    # (or max_iterations is reached), then the child (and the parent the other way, when symmetric)
+    # is moved to close the gap
+    max_iterations = 100
+
     def __init__(self, objects, symmetric = True, priority=0, sensitivity = 0.01):
         super().__init__(objects)
         if len(objects) < 2:
@@ -111,32 +559,226 @@ class EdgeConstraint(Constraint):
         self.sensitivity = sensitivity
         self.symmetric = symmetric
 
+    def contact(self, child):
+        #the gap from the child's edge to the parent's edge, and whether the search settled
+        change = -1
+        i = 0
+        child_edge = None
+        last_host_edge = child.location + self.parent_object.tangent_vector(child.location)
+        #we actually don't usually need more than one iteration here, but it's worth keeping it in as a catch if we can't converge
+        while change > self.sensitivity or change < 0:
+            i += 1
+            if i > self.max_iterations:
+                break
+            host_edge_to_child_edge = child.tangent_vector(last_host_edge)
+            child_edge = last_host_edge + host_edge_to_child_edge
+            child_edge_to_host_edge = self.parent_object.tangent_vector(child_edge)
+            host_edge = child_edge + child_edge_to_host_edge
+            change = (host_edge - last_host_edge).norm()
+            last_host_edge = host_edge
+        return last_host_edge - child_edge, i <= self.max_iterations
+
+    def moves(self, child, delta):
+        if self.symmetric:
+            return [(child, delta/2), (self.parent_object, -delta/2)]
+        return [(child, delta)]
+
+    def corrections(self):
+        moves = []
+        residual = 0.0
+        unsettled = 0
+        for child in self.child_objects:
+            delta, settled = self.contact(child)
+            unsettled += not settled
+            residual = max(residual, delta.norm())
+            moves += self.moves(child, delta)
+        return moves, residual, unsettled
+
     def apply(self):
+        #each child is moved before the next one is looked at
+        stats = SolveStats()
+        start = time.perf_counter()
+        stats.residual = 0.0
         for child in self.child_objects:
-            change = -1
-            i = 0
-            child_edge = None
-            last_host_edge = child.location + self.parent_object.tangent_vector(child.location)
-            #we actually don't usually need more than one iteration here, but it's worth keeping it in as a catch if we can't converge
-            while change > self.sensitivity or change < 0:
-                i += 1
-                if i > 100:
-                    print("didn't converge")
-                    break
-                host_edge_to_child_edge = child.tangent_vector(last_host_edge)
-                child_edge = last_host_edge + host_edge_to_child_edge
-                child_edge_to_host_edge = self.parent_object.tangent_vector(child_edge)
-                host_edge = child_edge + child_edge_to_host_edge
-                change = (host_edge - last_host_edge).norm()
-                last_host_edge = host_edge
-
-            delta = last_host_edge - child_edge
-            if self.symmetric:
-                child.move(delta/2)
-                self.parent_object.move(-delta/2)
+            delta, settled = self.contact(child)
+            stats.unsettled += not settled
+            stats.residual = max(stats.residual, delta.norm())
+            for obj, vector in self.moves(child, delta):
+                obj.move(vector)
+        stats.sweeps = 1
+        stats.converged = stats.unsettled == 0
+        stats.wall_time = time.perf_counter() - start
+        return stats
+
+class ConstraintSystem:
+    # solves many constraints together, sweeping over all of them until the largest violation seen in a
+    # sweep is at most tolerance, or max_sweeps / max_time (seconds) run out.
+    # "gauss-seidel" applies each constraint in turn, so later ones see the earlier moves. "jacobi" works
+    # out every correction from the same positions, then moves each structure once by the average of the
+    # corrections it got (times relaxation, over 1 takes bigger steps and usually fewer sweeps), so the
+    # result doesn't depend on the order of the constraints.
+    # with numpy, jacobi runs all the edge contact searches of a sweep side by side, with one batched
+    # tangent_vectors call per structure per bounce.
+    # given a broad_phase (a SweepAndPrune), each solve also gets a constraint between every pair of
+    # structures whose boxes overlap in it when the solve starts, made by contact(a, b) (an EdgeConstraint
+    # with contact_sensitivity by default). pairs are only looked for at the start, so that contacts
+    # made during a solve don't keep pulling in more structures before it settles
+    def __init__(self, constraints = None, mode = "gauss-seidel", tolerance = 0.01, max_sweeps = 100, max_time = None, relaxation = 1.0,
+            broad_phase = None, contact = None, contact_sensitivity = 0.01):
+        if mode not in ("gauss-seidel", "jacobi"):
+            raise ValueError(f"unknown mode {mode!r}")
+        self.constraints = [] if constraints is None else list(constraints)
+        self.mode = mode
+        self.tolerance = tolerance
+        self.max_sweeps = max_sweeps
+        self.max_time = max_time
+        self.relaxation = relaxation
+        self.broad_phase = broad_phase
+        self.contact = contact
+        self.contact_sensitivity = contact_sensitivity
+        self.contacts = {}
+
+    def add(self, constraint):
+        self.constraints.append(constraint)
+
+    def remove(self, constraint):
+        self.constraints.remove(constraint)
+
+    def contact_constraints(self):
+        #the constraints for the pairs the broad phase has close together now, a pair that stays close
+        #keeps its constraint
+        contacts = {}
+        for a, b in self.broad_phase.pairs():
+            key = (id(a), id(b)) if id(a) < id(b) else (id(b), id(a))
+            constraint = self.contacts.get(key)
+            if constraint is None:
+                if self.contact is not None:
+                    constraint = self.contact(a, b)
+                else:
+                    constraint = EdgeConstraint([a, b], sensitivity=self.contact_sensitivity)
+            contacts[key] = constraint
+        self.contacts = contacts
+        return list(contacts.values())
+
+    def solve(self):
+        stats = SolveStats()
+        start = time.perf_counter()
+        constraints = self.constraints
+        if self.broad_phase is not None:
+            constraints = constraints + self.contact_constraints()
+        while stats.sweeps < self.max_sweeps:
+            if self.mode == "gauss-seidel":
+                residual, unsettled = self.sweep_gauss_seidel(constraints)
             else:
-                child.move(delta)
-            
+                residual, unsettled = self.sweep_jacobi(constraints)
+            stats.sweeps += 1
+            stats.residual = residual
+            stats.unsettled += unsettled
+            if residual <= self.tolerance:
+                stats.converged = True
+                break
+            if self.max_time is not None and time.perf_counter() - start > self.max_time:
+                break
+        stats.wall_time = time.perf_counter() - start
+        return stats
+
+    def sweep_gauss_seidel(self, constraints):
+        residual = 0.0
+        unsettled = 0
+        for constraint in constraints:
+            result = constraint.apply()
+            residual = max(residual, result.residual)
+            unsettled += result.unsettled
+        return residual, unsettled
+
+    def sweep_jacobi(self, constraints):
+        moves = []
+        residual = 0.0
+        unsettled = 0
+        pairs = []
+        for constraint in constraints:
+            if np is not None and type(constraint) is EdgeConstraint:
+                pairs += [(constraint, child) for child in constraint.child_objects]
+                continue
+            constraint_moves, constraint_residual, constraint_unsettled = constraint.corrections()
+            moves += constraint_moves
+            residual = max(residual, constraint_residual)
+            unsettled += constraint_unsettled
+        if not pairs:
+            #every structure is moved once, by the average of its corrections
+            totals = {}
+            for obj, vector in moves:
+                if id(obj) in totals:
+                    _, total, count = totals[id(obj)]
+                    totals[id(obj)] = (obj, total + vector, count + 1)
+                else:
+                    totals[id(obj)] = (obj, vector, 1)
+            for obj, total, count in totals.values():
+                obj.move(total * (self.relaxation / count))
+            return residual, unsettled
+        #the same with arrays, indexed by structure, the edge contacts all searched at once
+        deltas, settled = batched_contacts(pairs)
+        residual = max(residual, float(deltas.norm().max()))
+        unsettled += int(len(settled) - settled.sum())
+        structures = {}
+        for obj in [obj for obj, _ in moves] + [obj for pair in pairs for obj in (pair[1], pair[0].parent_object)]:
+            structures.setdefault(id(obj), (len(structures), obj))
+        totals = np.zeros((len(structures), 2))
+        counts = np.zeros(len(structures))
+        children = np.array([structures[id(child)][0] for _, child in pairs])
+        parents = np.array([structures[id(constraint.parent_object)][0] for constraint, _ in pairs])
+        symmetric = np.array([constraint.symmetric for constraint, _ in pairs])
+        np.add.at(totals, children, deltas.xy * np.where(symmetric, 0.5, 1.0)[:, np.newaxis])
+        np.add.at(counts, children, 1)
+        np.add.at(totals, parents[symmetric], -0.5 * deltas.xy[symmetric])
+        np.add.at(counts, parents[symmetric], 1)
+        for obj, vector in moves:
+            i = structures[id(obj)][0]
+            totals[i] += vector.x, vector.y
+            counts[i] += 1
+        moved = np.flatnonzero(counts)
+        totals = totals[moved] * (self.relaxation / counts[moved])[:, np.newaxis]
+        objects = [obj for _, obj in structures.values()]
+        for i, (x, y) in zip(moved.tolist(), totals.tolist()):
+            objects[i].move(V(x, y))
+        return residual, unsettled
+
+def batched_tangents(owners, points):
+    #the tangent vector from each point (a row of an n x 2 array) to the structure at the same index in
+    #owners, with one tangent_vectors_of call per class of structure
+    groups = {}
+    for i, owner in enumerate(owners):
+        groups.setdefault(type(owner), []).append(i)
+    tangents = np.empty_like(points)
+    for kind, index in groups.items():
+        tangents[index] = kind.tangent_vectors_of([owners[i] for i in index], points[index])
+    return tangents
+
+def batched_contacts(pairs):
+    #EdgeConstraint.contact for many (constraint, child) pairs at once, returns the gaps as a VArray
+    #and which searches settled
+    parents = [constraint.parent_object for constraint, _ in pairs]
+    children = [child for _, child in pairs]
+    sensitivity = np.array([constraint.sensitivity for constraint, _ in pairs])
+    max_iterations = np.array([constraint.max_iterations for constraint, _ in pairs])
+    locations = VArray.from_points([child.location for child in children]).xy
+    last_host_edge = locations + batched_tangents(parents, locations)
+    child_edge = np.full_like(last_host_edge, np.nan)
+    active = np.ones(len(pairs), dtype=bool)
+    iterations = np.zeros(len(pairs), dtype=int)
+    while active.any():
+        index = np.flatnonzero(active)
+        iterations[index] += 1
+        index = index[iterations[index] <= max_iterations[index]]
+        if len(index) == 0:
+            break
+        child_edge[index] = last_host_edge[index] + batched_tangents([children[i] for i in index], last_host_edge[index])
+        host_edge = child_edge[index] + batched_tangents([parents[i] for i in index], child_edge[index])
+        change = VArray(host_edge - last_host_edge[index]).norm()
+        last_host_edge[index] = host_edge
+        active[:] = False
+        active[index] = change > sensitivity[index]
+    return VArray(last_host_edge - child_edge), iterations <= max_iterations
 
 debug = [None]*10
 if __name__ == "__main__":
@@ -155,34 +797,27 @@ if __name__ == "__main__":
     edge_constraint = EdgeConstraint([shape, shape2], sensitivity=0.1)
     edge_constraint2 = EdgeConstraint([shape, shape3], sensitivity=0.1)
     edge_constraint3 = EdgeConstraint([shape2, shape3], sensitivity=0.1)
+    #the scene is kept between frames, moved shapes are updated in it and only their surroundings get redrawn
     edge_constraint.apply()
-    scene = Scene([])
-    shape.render_in(scene, Material("#"), fill_material=Material("."))
-    shape2.render_in(scene, Material("#"), fill_material=Material("*"))
-    shape3.render_in(scene, Material("#"), fill_material=Material("^"))
+    for s in (shape, shape2, shape3):
+        s.update_in(scene)
     print(scene.render())
     edge_constraint2.apply()
-    scene = Scene([])
-    shape.render_in(scene, Material("#"), fill_material=Material("."))
-    shape2.render_in(scene, Material("#"), fill_material=Material("*"))
-    shape3.render_in(scene, Material("#"), fill_material=Material("^"))
+    for s in (shape, shape2, shape3):
+        s.update_in(scene)
     print(scene.render())
     edge_constraint3.apply()
-    scene = Scene([])
-    shape.render_in(scene, Material("#"), fill_material=Material("."))
-    shape2.render_in(scene, Material("#"), fill_material=Material("*"))
-    shape3.render_in(scene, Material("#"), fill_material=Material("^"))
+    for s in (shape, shape2, shape3):
+        s.update_in(scene)
     print(scene.render())
 
-    for i in range(1):
-        edge_constraint.apply()
-        edge_constraint2.apply()
-        edge_constraint3.apply()
-        scene = Scene([])
-        shape.render_in(scene, Material("#"), fill_material=Material("."))
-        shape2.render_in(scene, Material("#"), fill_material=Material("*"))
-        shape3.render_in(scene, Material("#"), fill_material=Material("^"))
-        #debug_circle = CircleS(debug[0],0.5)
-        #debug_circle.render_in(scene, Material("C", 1), fill_material=Material("C", 1))
+    #then let a constraint system settle all three together
+    system = ConstraintSystem([edge_constraint, edge_constraint2, edge_constraint3], tolerance=0.1)
+    stats = system.solve()
+    for s in (shape, shape2, shape3):
+        s.update_in(scene)
+    #debug_circle = CircleS(debug[0],0.5)
+    #debug_circle.render_in(scene, Material("C", 1), fill_material=Material("C", 1))
 
     print(scene.render())
+    print(stats)
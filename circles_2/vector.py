@@ -1,35 +1,75 @@
 import math
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 class V:
+    # a 2d vector. slotted, since structures and constraints make a lot of them
+    # the in-place operators (+=, -=, *=, /=) change the vector itself, so a V that is shared between
+    # several owners moves for all of them
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
 
     def __add__(self, other): #addition
-        if(type(other) == int or type(other) == float):
-            return V(self.x + other, self.y + other)
-        return V(self.x + other.x, self.y + other.y)
+        if isinstance(other, V):
+            return V(self.x + other.x, self.y + other.y)
+        if isinstance(other, VArray):
+            return NotImplemented
+        return V(self.x + other, self.y + other)
 
     def __radd__(self, other): #addition
-        if(type(other) == int or type(other) == float):
-            return V(self.x + other, self.y + other)
-        return V(self.x + other.x, self.y + other.y)
+        return self.__add__(other)
+
+    def __iadd__(self, other):
+        if isinstance(other, V):
+            self.x += other.x
+            self.y += other.y
+        else:
+            self.x += other
+            self.y += other
+        return self
 
     def __sub__(self, other): #subtraction
+        if isinstance(other, VArray):
+            return NotImplemented
         return V(self.x - other.x, self.y - other.y)
 
+    def __isub__(self, other):
+        self.x -= other.x
+        self.y -= other.y
+        return self
+
     def __mul__(self, other): #scalar multiplication and dot product
         if isinstance(other, V):
             return self.x * other.x + self.y * other.y
+        elif isinstance(other, VArray):
+            return NotImplemented
         else:
             return V(self.x * other, self.y * other)
 
     def __rmul__(self, other): #scalar multiplication
         return V(self.x * other, self.y * other)
 
+    def __imul__(self, other): #scalar multiplication, a dot product can't be done in place
+        if isinstance(other, V):
+            return self * other
+        self.x *= other
+        self.y *= other
+        return self
+
     def __truediv__(self, other): #scalar division
         return V(self.x / other, self.y / other)
 
+    def __itruediv__(self, other):
+        self.x /= other
+        self.y /= other
+        return self
+
     def __neg__(self): #negation
         return V(-self.x, -self.y)
 
@@ -39,29 +79,174 @@ class V:
     def __str__(self):
         return "({}, {})".format(self.x, self.y)
 
+    def copy(self):
+        return V(self.x, self.y)
+
     def norm(self):
         return math.sqrt(self.x**2 + self.y**2)
 
+    def norm_squared(self):
+        return self.x**2 + self.y**2
+
     def normalized(self):
         return self / self.norm()
 
     def rotate(self, angle):
         return V(self.x * math.cos(angle) - self.y * math.sin(angle), self.x * math.sin(angle) + self.y * math.cos(angle))
 
+    # comparisons are by length, done on the squared lengths to skip the square roots
     def __lt__(self, other):
-        return self.norm() < other.norm()
+        return self.norm_squared() < other.norm_squared()
 
     def __le__(self, other):
-        return self.norm() <= other.norm()
+        return self.norm_squared() <= other.norm_squared()
 
     def __gt__(self, other):
-        return self.norm() > other.norm()
+        return self.norm_squared() > other.norm_squared()
 
     def __ge__(self, other):
-        return self.norm() >= other.norm()
+        return self.norm_squared() >= other.norm_squared()
 
     def __eq__(self, other):
         return self.x == other.x and self.y == other.y
 
-    def __neq__(self, other):
+    def __ne__(self, other):
         return self.x != other.x or self.y != other.y
+
+class VArray:
+    # many 2d vectors in one contiguous n x 2 numpy array, with the same operations as V applied to all
+    # of them at once. the other operand can be a VArray of the same length, a single V (applied to every
+    # vector) or a number. indexing with an int gives a V copy, with a slice or mask a VArray view
+    __slots__ = ('xy',)
+
+    def __init__(self, xy):
+        if np is None:
+            raise ImportError("VArray needs numpy")
+        xy = np.asarray(xy, dtype=float)
+        if xy.ndim != 2 or xy.shape[1] != 2:
+            xy = xy.reshape(-1, 2)
+        self.xy = xy
+
+    @classmethod
+    def from_points(cls, points):
+        return cls([(p.x, p.y) for p in points])
+
+    @classmethod
+    def zeros(cls, n):
+        return cls(np.zeros((n, 2)))
+
+    def to_points(self):
+        return [V(x, y) for x, y in self.xy.tolist()]
+
+    @property
+    def x(self):
+        return self.xy[:, 0]
+
+    @property
+    def y(self):
+        return self.xy[:, 1]
+
+    def __len__(self):
+        return len(self.xy)
+
+    def __iter__(self):
+        return iter(self.to_points())
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            x, y = self.xy[index]
+            return V(float(x), float(y))
+        return VArray(self.xy[index])
+
+    def __setitem__(self, index, value):
+        self.xy[index] = VArray.operand(value)
+
+    def copy(self):
+        return VArray(self.xy.copy())
+
+    @staticmethod
+    def operand(other):
+        # other as something that broadcasts against an n x 2 array
+        if isinstance(other, VArray):
+            return other.xy
+        if isinstance(other, V):
+            return np.array((other.x, other.y))
+        return other
+
+    def __add__(self, other):
+        return VArray(self.xy + VArray.operand(other))
+
+    def __radd__(self, other):
+        return self.__add__(other)
+
+    def __iadd__(self, other):
+        self.xy += VArray.operand(other)
+        return self
+
+    def __sub__(self, other):
+        return VArray(self.xy - VArray.operand(other))
+
+    def __rsub__(self, other):
+        return VArray(VArray.operand(other) - self.xy)
+
+    def __isub__(self, other):
+        self.xy -= VArray.operand(other)
+        return self
+
+    def __mul__(self, other): #scalar (or per vector) multiplication, or dot products with vectors
+        if isinstance(other, (V, VArray)):
+            return (self.xy * VArray.operand(other)).sum(axis=1)
+        return VArray(self.xy * VArray.column(other))
+
+    def __rmul__(self, other):
+        return self.__mul__(other)
+
+    def __imul__(self, other):
+        if isinstance(other, (V, VArray)):
+            return self * other
+        self.xy *= VArray.column(other)
+        return self
+
+    def __truediv__(self, other):
+        return VArray(self.xy / VArray.column(other))
+
+    def __itruediv__(self, other):
+        self.xy /= VArray.column(other)
+        return self
+
+    @staticmethod
+    def column(scale):
+        # a number, or one number per vector
+        scale = np.asarray(scale, dtype=float)
+        return scale[:, np.newaxis] if scale.ndim == 1 else scale
+
+    def __neg__(self):
+        return VArray(-self.xy)
+
+    def __repr__(self):
+        return "VArray({})".format(self.xy.tolist())
+
+    def norm(self):
+        return np.sqrt(self.norm_squared())
+
+    def norm_squared(self):
+        return self.xy[:, 0]**2 + self.xy[:, 1]**2
+
+    def normalized(self):
+        return self / self.norm()
+
+    def rotate(self, angle):
+        c, s = math.cos(angle), math.sin(angle)
+        return VArray(np.column_stack((self.xy[:, 0] * c - self.xy[:, 1] * s, self.xy[:, 0] * s + self.xy[:, 1] * c)))
+
+    def sum(self):
+        x, y = self.xy.sum(axis=0)
+        return V(float(x), float(y))
+
+    def mean(self):
+        x, y = self.xy.mean(axis=0)
+        return V(float(x), float(y))
+
+    def argmin(self):
+        # index of the shortest vector
+        return int(np.argmin(self.norm_squared()))
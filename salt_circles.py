@@ -1,7 +1,23 @@
 import random
 import math
 import time
-from flask import Flask
+import os
+import queue
+import threading
+import hashlib
+import collections
+import concurrent.futures
+from flask import Flask, Response, abort, jsonify, request, stream_with_context
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def square(a):
+    # float_power agrees with python's ** bit for bit, a*a can round differently in the last place
+    return np.float_power(a, 2)
 
 
 class Rune:
@@ -11,84 +27,170 @@ class Rune:
         self.bounds()
 
     def bounds(self):
-        self.x_bounds = [x,x]
-        self.y_bounds = [y,y]
+        # called whenever the rune moves, so anything derived from its position is rebuilt here
+        self.x_bounds = [self.x,self.x]
+        self.y_bounds = [self.y,self.y]
 
     def render(self,x,y):
         return False
 
+    def render_array(self, xs, ys):
+        # vectorized render over a grid: xs is a row of sub-pixel x values, ys a column of y values
+        # returns (layers, pending) where layers is a list of (character, mask) pairs and pending
+        # is a mask of cells that have to go through the scalar render (eg. because they draw randoms)
+        # runes without a vectorized form send every cell through render()
+        return None
+
 class Circle(Rune):
     def __init__(self, x, y, radius, width = 0.75, edge = "x", fill = "_"):
         self.radius = radius
-        Rune.__init__(self,x,y)
         self.width = width
-        self.bounds()
         self.edge = edge
         self.fill = fill
+        Rune.__init__(self,x,y)
 
     def bounds(self):
         self.x_bounds = [self.x-self.radius, self.x+self.radius]
         self.y_bounds = [self.y-self.radius, self.y+self.radius]
+        # geometry cache, anything further than reach from the center renders as nothing
+        # the squared reach is padded a hair so rounding in the squared distance never rejects a real hit
+        self.half_width = self.width/2
+        self.reach = self.radius + self.half_width
+        self.reach_squared = self.reach**2 * (1 + 1e-9)
 
     def render(self,x,y):
         if x == self.x and y == self.y:
             return False
         x_distance = x-self.x
         y_distance = y-self.y
-        distance = math.sqrt(x_distance**2 + y_distance**2)
+        distance_squared = x_distance**2 + y_distance**2
+        if distance_squared > self.reach_squared:
+            return False
+        distance = math.sqrt(distance_squared)
         deviation = distance - self.radius
-        if abs(deviation) <= self.width/2:
+        if abs(deviation) <= self.half_width:
             return self.edge
         elif distance <= self.radius:
             return self.fill
         else:
             return False
 
+    def render_array(self, xs, ys):
+        x_distance = xs - self.x
+        y_distance = ys - self.y
+        distance = np.sqrt(square(x_distance) + square(y_distance))
+        deviation = distance - self.radius
+        outside_center = (xs != self.x) | (ys != self.y)
+        edge = (np.abs(deviation) <= self.half_width) & outside_center
+        fill = (distance <= self.radius) & outside_center & ~edge
+        return [(self.edge, edge), (self.fill, fill)], None
+
     def __repr__(self):
         return(f"<X:{self.x}, Y:{self.y}, Radius: {self.radius}, Bounds:{self.x_bounds, self.y_bounds}>")
 
 class StarredCircle(Circle):
 
-    def point_on_line(x1, y1, x2, y2, px, py, width=0.5):
-        # project 1p onto 12
+    star_width = 0.25
+
+    def point_on_line(x1, y1, x2, y2, px, py, width=0.5, rng=random):
+        return StarredCircle.point_on_segment(StarredCircle.segment(x1, y1, x2, y2), px, py, width, rng)
 
+    def segment(x1, y1, x2, y2):
+        # the parts of a line that point_on_segment needs that don't depend on the point
         AB = (x2-x1, y2-y1)
+        return (x1, y1, AB[0], AB[1], AB[0]**2 + AB[1]**2)
+
+    def point_on_segment(segment, px, py, width=0.5, rng=random):
+        # project 1p onto 12
+        x1, y1, AB_x, AB_y, length = segment
+
         AP = (px-x1, py-y1)
 
-        projection_x = AB[0] * (AB[0]*AP[0] + AB[1]*AP[1]) / (AB[0]**2 + AB[1]**2)
-        projection_y = AB[1] * (AB[0]*AP[0] + AB[1]*AP[1]) / (AB[0]**2 + AB[1]**2)
+        projection_x = AB_x * (AB_x*AP[0] + AB_y*AP[1]) / length
+        projection_y = AB_y * (AB_x*AP[0] + AB_y*AP[1]) / length
 
         deviation_x = AP[0] - projection_x
         deviation_y = AP[1] - projection_y
 
         deviation = math.sqrt(deviation_x**2 + deviation_y**2)
 
-        between = (projection_x >= 0 and projection_x <= AB[0]) or (projection_x <= 0 and projection_x >= AB[0])
+        between = (projection_x >= 0 and projection_x <= AB_x) or (projection_x <= 0 and projection_x >= AB_x)
         if projection_x == 0:
-            between = (projection_y >= 0 and projection_y <= AB[1]) or (projection_y <= 0 and projection_y >= AB[1])
+            between = (projection_y >= 0 and projection_y <= AB_y) or (projection_y <= 0 and projection_y >= AB_y)
 
         if deviation <= width and between:
             return True
         elif deviation <= width*2 and between:
-            if random.random() < 0.5:
+            if rng.random() < 0.5:
                 return True
         else:
             return False
 
+    def point_on_segment_array(segment, px, py, width=0.5):
+        # vectorized point_on_segment over a grid of points
+        # returns two masks: points that are on the line, and points in the outer band that point_on_segment
+        # would flip a coin for
+        x1, y1, AB_x, AB_y, length = segment
+
+        AP = (px-x1, py-y1)
+
+        dot = AB_x*AP[0] + AB_y*AP[1]
+        projection_x = AB_x * dot / length
+        projection_y = AB_y * dot / length
+
+        deviation_x = AP[0] - projection_x
+        deviation_y = AP[1] - projection_y
+
+        deviation = np.sqrt(square(deviation_x) + square(deviation_y))
+
+        between = ((projection_x >= 0) & (projection_x <= AB_x)) | ((projection_x <= 0) & (projection_x >= AB_x))
+        between_y = ((projection_y >= 0) & (projection_y <= AB_y)) | ((projection_y <= 0) & (projection_y >= AB_y))
+        between = np.where(projection_x == 0, between_y, between)
+
+        on_line = (deviation <= width) & between
+        near_line = (deviation <= width*2) & between & ~on_line
+        return on_line, near_line
+
     
-    def __init__(self, x, y, radius, width = 0.75, edge = "x", fill = "_", star = "@", inverted = False):
-        Circle.__init__(self,x,y,radius, edge = edge, fill = fill)
+    def __init__(self, x, y, radius, width = 0.75, edge = "x", fill = "_", star = "@", inverted = False, rng = None):
         self.star = star
         self.inverted = inverted
+        # where the coin flips for the star's ragged edges come from, the global random module by default
+        self.rng = random if rng is None else rng
+        Circle.__init__(self,x,y,radius, edge = edge, fill = fill)
+
+    def bounds(self):
+        Circle.bounds(self)
+        star_points = self.star_points()
+        self.star_segments = [StarredCircle.segment(*star_points[i], *star_points[i+2]) for i in range(0,5)]
+        # the star's lines are chords of the circle, so their outer band can poke out past the edge band
+        self.reach = max(self.reach, self.radius + StarredCircle.star_width*2)
+        self.reach_squared = self.reach**2 * (1 + 1e-9)
 
     def render(self,x,y):
         if x == self.x and y == self.y:
             return False
         x_distance = x-self.x
         y_distance = y-self.y
-        distance = math.sqrt(x_distance**2 + y_distance**2)
+        distance_squared = x_distance**2 + y_distance**2
+        if distance_squared > self.reach_squared:
+            return False
+        distance = math.sqrt(distance_squared)
         deviation = distance - self.radius
 
+        for segment in self.star_segments:
+            if StarredCircle.point_on_segment(segment, x, y, width = StarredCircle.star_width, rng = self.rng):
+                return self.star
+
+        if abs(deviation) <= self.half_width:
+            return self.edge
+        elif distance <= self.radius:
+            return self.fill
+        else:
+            return False
+
+    def star_points(self):
+        # the five points of the star, with the first two repeated so each line is points[i] to points[i+2]
         star_points = []
         for i in range(0,5):
             if not self.inverted:
@@ -99,21 +201,36 @@ class StarredCircle(Circle):
 
         star_points.append(star_points[0])
         star_points.append(star_points[1])
-        for i in range(0,5):
-            if StarredCircle.point_on_line(star_points[i][0], star_points[i][1], star_points[i+2][0], star_points[i+2][1], x, y, width = 0.25):
-                return self.star
+        return star_points
 
-        if abs(deviation) <= self.width/2:
-            return self.edge
-        elif distance <= self.radius:
-            return self.fill
-        else:
-            return False
+    def render_array(self, xs, ys):
+        layers, _ = Circle.render_array(self, xs, ys)
+        outside_center = (xs != self.x) | (ys != self.y)
+
+        # render() returns the star for the first line a point is on, but flips a coin for every line
+        # whose outer band it hits before that, so any cell where a near-line comes first is left to
+        # the scalar path to keep the random draws in the same order
+        star = np.zeros(outside_center.shape, dtype=bool)
+        pending = np.zeros(outside_center.shape, dtype=bool)
+        for segment in self.star_segments:
+            on_line, near_line = StarredCircle.point_on_segment_array(segment, xs, ys, width = StarredCircle.star_width)
+            pending |= near_line & ~star
+            star |= on_line & ~pending
+
+        star &= outside_center
+        pending &= outside_center
+        layers = [(self.star, star)] + [(character, mask & ~star & ~pending) for character, mask in layers]
+        return layers, pending
 
 
 class Force():
-    def __init__(self, function):
+    # a force between two runes, the function gives the force on a from b
+    # a kernel is the same force for whole arrays of runes at once: it takes the positions and radii of
+    # a and b as broadcastable arrays (radius is nan for runes without one) and returns the x and y
+    # components, so simulate can run it over every pair without going through the rune objects
+    def __init__(self, function, kernel = None):
         self.function = function
+        self.kernel = kernel
 
     def __call__(self, a, b):
         return self.function(a,b)
@@ -140,6 +257,24 @@ def edge_attraction(a,b):
     else:
         return delta
 
+def edge_attraction_kernel(a_x, a_y, a_radius, b_x, b_y, b_radius):
+    x_distance = b_x - a_x
+    y_distance = b_y - a_y
+    distance = np.sqrt(square(x_distance) + square(y_distance))
+    small = a_radius < 4
+    deviation = np.where(small, np.abs(distance - b_radius), np.abs(distance - (a_radius + b_radius)))
+
+    falloff = square(deviation+4)
+    delta_x = x_distance/falloff
+    delta_y = y_distance/falloff
+    distance = np.where(small, distance + a_radius, distance)
+    inside = distance < a_radius + b_radius
+    delta_x = np.where(inside, -delta_x, delta_x)
+    delta_y = np.where(inside, -delta_y, delta_y)
+
+    has_radius = ~(np.isnan(a_radius) | np.isnan(b_radius))
+    return np.where(has_radius, delta_x, 0.0), np.where(has_radius, delta_y, 0.0)
+
 def strong_centration(a,b):
     if not hasattr(a, "radius") or not hasattr(b, "radius"):
         return [0,0]
@@ -154,27 +289,82 @@ def strong_centration(a,b):
     else:
         return [0,0]
 
+def strong_centration_kernel(a_x, a_y, a_radius, b_x, b_y, b_radius):
+    # only the first two entries of the scalar version's delta are ever used, which is the plain vector to b
+    x_distance = b_x - a_x
+    y_distance = b_y - a_y
+    distance = np.sqrt(square(x_distance) + square(y_distance))
+    radius_difference = np.abs(a_radius - b_radius)
+    active = (radius_difference > 1) & (radius_difference < 8) & (distance < b_radius-3)
+    return np.where(active, x_distance, 0.0), np.where(active, y_distance, 0.0)
+
         
-edge_attraction = Force(edge_attraction)
-strong_centration = Force(strong_centration)
+edge_attraction = Force(edge_attraction, edge_attraction_kernel)
+strong_centration = Force(strong_centration, strong_centration_kernel)
     
-def render(runes):
+character_heirarchy = ["@","x","_", ".", " "]
+
+def canvas_bounds(runes):
     x_min = round(min([r.x_bounds[0] for r in runes]) - 0.5)
     x_max = round(max([r.x_bounds[1] for r in runes]) + 0.5)
     y_min = round(min([r.y_bounds[0] for r in runes]) - 0.5)
     y_max = round(max([r.y_bounds[1] for r in runes]) + 0.5)
+    return x_min, x_max, y_min, y_max
 
-    buffer = ""
-    character_heirarchy = ["@","x","_", ".", " "]
+def render(runes):
+    return "".join(render_rows(runes))
 
-    for y in range(y_min, y_max+1):
-        for x in range(x_min*2, (x_max+1)*2):
+def render_rows(runes):
+    # the same text as render, one finished row (with its newline) at a time
+    if np is None:
+        return render_rows_scalar(runes)
+    return render_rows_vectorized(runes)
+
+def render_scalar(runes):
+    return "".join(render_rows_scalar(runes))
+
+def render_vectorized(runes):
+    return "".join(render_rows_vectorized(runes))
+
+class RowIndex:
+    # row-interval index over the runes' reach, built once per render pass
+    # each rune gets a window of canvas rows and columns it can possibly draw in, and every row keeps
+    # the runes whose window covers it (in rune order, so draws and overrides happen in the same order)
+    def __init__(self, runes, x_min, x_max, y_min, y_max):
+        self.width = (x_max+1 - x_min)*2
+        self.height = y_max+1 - y_min
+        self.windows = []
+        self.rows = [[] for _ in range(self.height)]
+        for index, rune in enumerate(runes):
+            reach = getattr(rune, "reach", None)
+            if reach is None:
+                # no idea where this rune draws, so it gets asked about every cell
+                window = (0, self.height, 0, self.width)
+            else:
+                row_start = max(0, math.floor(rune.y - reach) - y_min)
+                row_end = min(self.height, math.ceil(rune.y + reach) - y_min + 1)
+                column_start = max(0, math.floor((rune.x - reach)*2) - x_min*2)
+                column_end = min(self.width, math.ceil((rune.x + reach)*2) - x_min*2 + 1)
+                window = (row_start, max(row_start, row_end), column_start, max(column_start, column_end))
+            self.windows.append(window)
+            for row in range(window[0], window[1]):
+                self.rows[row].append((index, rune, window[2], window[3]))
+
+def render_rows_scalar(runes):
+    x_min, x_max, y_min, y_max = canvas_bounds(runes)
+    index = RowIndex(runes, x_min, x_max, y_min, y_max)
+
+    for row, y in enumerate(range(y_min, y_max+1)):
+        row_runes = index.rows[row]
+        characters = []
+        for column, x in enumerate(range(x_min*2, (x_max+1)*2)):
             x = x/2
             character_candidates = [" "]
-            for rune in runes:
-                result = rune.render(x,y)
-                if result:
-                    character_candidates.append(result)
+            for _, rune, column_start, column_end in row_runes:
+                if column_start <= column < column_end:
+                    result = rune.render(x,y)
+                    if result:
+                        character_candidates.append(result)
 
             character = filter(lambda x: x in character_candidates, character_heirarchy).__next__()
             for c in character_candidates:
@@ -183,14 +373,211 @@ def render(runes):
                     
             if character == "_":
                 character = " "
-            buffer += character
-        buffer += "\n"
+            characters.append(character)
+        characters.append("\n")
+        yield "".join(characters)
+
+def render_rows_vectorized(runes, band = 32):
+    # same output as render_rows_scalar, but every rune is rendered over its window of the sub-pixel grid
+    # at once. the grid is worked through in bands of rows, so memory stays bounded by the band
+    for codes, characters in render_codes(runes, band):
+        table = np.array([" " if c == "_" else c for c in characters], dtype=object)
+        for row in table[codes].tolist():
+            yield "".join(row) + "\n"
+
+def render_into(runes, out = None, band = 32):
+    # the rendered text, utf-8 encoded, written into the bytearray out (or a new one if out isn't given
+    # or is too small) and returned as a memoryview of it, so a caller rendering over and over can keep
+    # writing into the same memory. rows are a fixed canvas width + 1 bytes apart when every character
+    # is ascii, which the vectorized path then fills in straight from the character codes
+    x_min, x_max, y_min, y_max = canvas_bounds(runes)
+    width = (x_max+1 - x_min)*2
+    height = y_max+1 - y_min
+    size = height*(width + 1)
+    if np is None:
+        return write_into(out, render_scalar(runes).encode())
+
+    if out is None or len(out) < size:
+        out = bytearray(size)
+    frame = np.frombuffer(out, dtype=np.uint8, count=size).reshape(height, width + 1)
+    frame[:, -1] = ord("\n")
+    row = 0
+    text = None
+    for codes, characters in render_codes(runes, band):
+        characters = [" " if c == "_" else c for c in characters]
+        table = "".join(characters).encode()
+        if text is None and len(table) == len(characters):
+            frame[row:row + len(codes), :-1] = np.frombuffer(table, dtype=np.uint8)[codes]
+        else:
+            # a multi byte character, so rows can't be a fixed width apart: from here on they are encoded one by one
+            if text is None:
+                text = [bytes(frame[:row])]
+            text += [("".join(r) + "\n").encode() for r in np.array(characters, dtype=object)[codes].tolist()]
+        row += len(codes)
+    if text is not None:
+        return write_into(out, b"".join(text))
+    return memoryview(out)[:size]
+
+def write_into(out, data):
+    if out is None or len(out) < len(data):
+        out = bytearray(len(data))
+    out[:len(data)] = data
+    return memoryview(out)[:len(data)]
+
+def render_bytes(runes):
+    return bytes(render_into(runes))
+
+def render_codes(runes, band = 32):
+    # the vectorized render pass, yields every band of rows as an array of indices into the list of
+    # characters it yields alongside (which grows as runes bring in new ones)
+    x_min, x_max, y_min, y_max = canvas_bounds(runes)
+    index = RowIndex(runes, x_min, x_max, y_min, y_max)
+    xs = (np.arange(x_min*2, (x_max+1)*2) / 2)[np.newaxis, :]
+    characters = list(character_heirarchy)
+
+    for band_start in range(0, index.height, band):
+        band_end = min(band_start + band, index.height)
+        ys = np.arange(y_min + band_start, y_min + band_end, dtype=float)[:, np.newaxis]
+        shape = (ys.shape[0], xs.shape[1])
+
+        # characters are resolved as codes: the best hierarchy rank per cell, plus the last character
+        # outside the hierarchy (and which rune it came from, so late scalar cells can't override later runes)
+        rank = np.full(shape, characters.index(" "), dtype=np.intp)
+        extra = np.full(shape, -1, dtype=np.intp)
+        extra_rune = np.full(shape, -1, dtype=np.intp)
+
+        def apply(rune_index, character, window, mask):
+            if not character:
+                return
+            rank_window, extra_window, extra_rune_window = rank[window], extra[window], extra_rune[window]
+            if character in character_heirarchy:
+                rank_window[mask] = np.minimum(rank_window[mask], character_heirarchy.index(character))
+            else:
+                if character not in characters:
+                    characters.append(character)
+                later = extra_rune_window[mask] < rune_index
+                extra_window[mask] = np.where(later, characters.index(character), extra_window[mask])
+                extra_rune_window[mask] = np.where(later, rune_index, extra_rune_window[mask])
 
-    return buffer
+        pending_cells = []
+        for rune_index, rune in enumerate(runes):
+            row_start, row_end, column_start, column_end = index.windows[rune_index]
+            row_start, row_end = max(row_start, band_start) - band_start, min(row_end, band_end) - band_start
+            if row_start >= row_end or column_start == column_end:
+                continue
+            window = (slice(row_start, row_end), slice(column_start, column_end))
+            result = rune.render_array(xs[:, window[1]], ys[window[0], :])
+            if result is None:
+                layers, pending = [], np.ones((row_end - row_start, column_end - column_start), dtype=bool)
+            else:
+                layers, pending = result
+            for character, mask in layers:
+                apply(rune_index, character, window, mask)
+            if pending is not None:
+                rows, columns = np.nonzero(pending)
+                pending_cells += zip((rows + row_start).tolist(), (columns + column_start).tolist(), [rune_index]*len(rows))
+
+        # cells that need the scalar path go through it in the same order render_rows_scalar visits them
+        pending_cells.sort()
+        cell = np.ones((1, 1), dtype=bool)
+        for row, column, rune_index in pending_cells:
+            result = runes[rune_index].render(float(xs[0, column]), y_min + band_start + row)
+            if result:
+                apply(rune_index, result, (slice(row, row+1), slice(column, column+1)), cell)
+
+        yield np.where(extra >= 0, extra, rank), characters
+
+def check_deadline(deadline):
+    # deadlines are time.monotonic() values, which are comparable across processes on the same machine
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError("simulation ran past its deadline")
+
+class SimulationStats:
+    # what a simulate call did: how many iterations it ran, the largest distance a rune moved in the
+    # last one, how long it took, whether it stopped because it hit the tolerance, and the final step
+    def __init__(self, precision):
+        self.iterations = 0
+        self.residual = None
+        self.wall_time = 0.0
+        self.converged = False
+        self.precision = precision
+
+    def __repr__(self):
+        return(f"<Iterations: {self.iterations}, Residual: {self.residual}, Time: {self.wall_time:.3f}s, Converged: {self.converged}>")
+
+class AdaptiveStep:
+    # step size control for simulate. every window of iterations it compares how far each rune got
+    # (net displacement) with how far it travelled (path length): when every rune is just going back
+    # and forth, which is what the edge forces do once runes sit on each other's edges, the step is cut
+    # (the jitter there is proportional to the step, so this is also what lets the layout settle), and
+    # while every moving rune heads steadily one way it is allowed to grow
+    def __init__(self, precision, window = 100, grow = 1.2, shrink = 0.5, max_precision = None, settled = 0.3):
+        self.precision = precision
+        self.window = window
+        self.settled = settled
+        self.grow = grow
+        self.shrink = shrink
+        self.max_precision = precision*4 if max_precision is None else max_precision
+        self.reset()
+
+    def reset(self):
+        self.iterations = 0
+        self.net = None
+        self.path = None
 
-def simulate(runes, forces, iterations = 1000, precision = 0.01):
+    def update(self, moves_x, moves_y):
+        if self.net is None:
+            self.net = [[0.0, 0.0] for _ in moves_x]
+            self.path = [0.0 for _ in moves_x]
+        for net, i, x, y in zip(self.net, range(len(self.path)), moves_x, moves_y):
+            net[0] += x
+            net[1] += y
+            self.path[i] += math.sqrt(x**2 + y**2)
+        self.iterations += 1
+        if self.iterations < self.window:
+            return self.precision
+
+        # the runes as a group may keep drifting (the forces aren't symmetric), which says nothing about
+        # whether the layout itself has settled, so net displacements are taken relative to the mean one
+        mean_x = sum([x for x, _ in self.net])/len(self.net)
+        mean_y = sum([y for _, y in self.net])/len(self.net)
+        ratios = [math.sqrt((x - mean_x)**2 + (y - mean_y)**2)/path for (x, y), path in zip(self.net, self.path) if path > 0]
+        if ratios and max(ratios) < self.settled:
+            self.precision *= self.shrink
+        elif ratios and min(ratios) > 0.75:
+            self.precision = min(self.precision*self.grow, self.max_precision)
+        self.reset()
+        return self.precision
+
+def simulate(runes, forces, iterations = 1000, precision = 0.01, mode = "sequential", cutoff = None, skin = None, tolerance = None, adaptive = False, deadline = None):
+    # mode "sequential" moves one rune at a time, each seeing the moves made before it, which is how
+    # layouts have always been computed. mode "jacobi" moves every rune at once from the same snapshot,
+    # which is much faster for many runes but gives different (still reproducible) layouts
+    # a cutoff turns on the approximate mode: pairs whose edges are more than cutoff apart are ignored,
+    # which makes an iteration scale with the number of neighbors instead of the number of runes squared
+    # with a tolerance the simulation stops early once no rune moves further than it in an iteration,
+    # and adaptive grows and shrinks the step as the layout settles (see AdaptiveStep)
+    # past the deadline (a time.monotonic() value) it gives up with a TimeoutError
+    # returns a SimulationStats
+    if mode not in ("sequential", "jacobi"):
+        raise ValueError(f"unknown simulation mode {mode!r}")
+    if np is None and (mode != "sequential" or cutoff is not None):
+        raise ValueError("jacobi mode and cutoffs need numpy")
+    # both sequential paths give identical layouts, the arrays only pay off once there are enough runes
+    # to amortize numpy's per call overhead
+    if np is None or mode == "sequential" and cutoff is None and len(runes) < ForceEngine.min_sequential_runes:
+        return simulate_scalar(runes, forces, iterations, precision, tolerance, adaptive, deadline)
+    return ForceEngine(runes, forces, cutoff, skin).run(iterations, precision, mode, tolerance, adaptive, deadline)
+
+def simulate_scalar(runes, forces, iterations = 1000, precision = 0.01, tolerance = None, adaptive = False, deadline = None):
+    stats = SimulationStats(precision)
+    start = time.perf_counter()
+    step = AdaptiveStep(precision) if adaptive else None
     for i in range(iterations):
+        check_deadline(deadline)
+        moves = []
         for rune in runes:
+            x, y = rune.x, rune.y
             for force in forces:
                 comm_force = [0,0]
                 for other_rune in runes:
@@ -201,28 +588,502 @@ def simulate(runes, forces, iterations = 1000, precision = 0.01):
 
                 rune.x += comm_force[0] * precision
                 rune.y += comm_force[1] * precision
-                rune.bounds()
+            moves.append((rune.x - x, rune.y - y))
+
+        stats.iterations = i+1
+        stats.residual = max([math.sqrt(x**2 + y**2) for x, y in moves], default = 0.0)
+        if tolerance is not None and stats.residual < tolerance:
+            stats.converged = True
+            break
+        if step is not None:
+            precision = step.update([x for x, _ in moves], [y for _, y in moves])
+
+    # forces only look at positions and radii, so the bounds (and the render cache) are rebuilt once at the end
+    for rune in runes:
+        rune.bounds()
+    stats.precision = precision
+    stats.wall_time = time.perf_counter() - start
+    return stats
+
+class ForceEngine:
+    # structure of arrays view of a set of runes for simulate
+    # positions and radii live in contiguous arrays while simulating, and are written back to the runes
+    # (and their bounds rebuilt) once at the end
+    # with a cutoff, pairs whose edges are further apart than it are ignored (see NeighborList)
+    min_sequential_runes = 20
+
+    def __init__(self, runes, forces, cutoff = None, skin = None):
+        self.runes = runes
+        self.forces = forces
+        self.x = np.array([rune.x for rune in runes], dtype=float)
+        self.y = np.array([rune.y for rune in runes], dtype=float)
+        self.radius = np.array([getattr(rune, "radius", np.nan) for rune in runes], dtype=float)
+        # forces without a kernel go through the rune objects, which then have to be kept up to date
+        self.scalar = any(force.kernel is None for force in forces)
+        self.neighbors = None if cutoff is None else NeighborList(self, cutoff, skin)
+
+    def row_force(self, force, i):
+        # total force on rune i, summed in rune order like the scalar loop so results match it exactly
+        if self.neighbors is not None:
+            others = self.neighbors.row(i)
+            if len(others) == 0:
+                # nothing within the cutoff, an isolated rune feels no force
+                return 0.0, 0.0
+        else:
+            others = slice(None)
+        if force.kernel is None:
+            rune = self.runes[i]
+            if self.neighbors is not None:
+                deltas = [force(rune, self.runes[j]) for j in others.tolist()]
+            else:
+                deltas = [force(rune, other) if other is not rune else [0,0] for other in self.runes]
+            delta_x = np.array([d[0] for d in deltas] or [0.0], dtype=float)
+            delta_y = np.array([d[1] for d in deltas] or [0.0], dtype=float)
+        else:
+            delta_x, delta_y = force.kernel(self.x[i], self.y[i], self.radius[i], self.x[others], self.y[others], self.radius[others])
+            if self.neighbors is None:
+                delta_x[i] = 0.0
+                delta_y[i] = 0.0
+        if self.neighbors is not None and len(others):
+            within = self.neighbors.within(np.full(len(others), i), others)
+            delta_x = np.where(within, delta_x, 0.0)
+            delta_y = np.where(within, delta_y, 0.0)
+        # cumsum adds strictly left to right, np.sum would pair up terms and round differently
+        return np.cumsum(delta_x)[-1], np.cumsum(delta_y)[-1]
+
+    def pair_forces(self, force):
+        # n by n matrices of the force on each rune (row) from each other rune (column)
+        if force.kernel is None:
+            delta_x = np.zeros((len(self.runes), len(self.runes)))
+            delta_y = np.zeros((len(self.runes), len(self.runes)))
+            for i, rune in enumerate(self.runes):
+                for j, other in enumerate(self.runes):
+                    if other is not rune:
+                        delta_x[i, j], delta_y[i, j] = force(rune, other)[:2]
+        else:
+            column = np.newaxis
+            delta_x, delta_y = force.kernel(self.x[:, column], self.y[:, column], self.radius[:, column], self.x, self.y, self.radius)
+            np.fill_diagonal(delta_x, 0.0)
+            np.fill_diagonal(delta_y, 0.0)
+        return delta_x, delta_y
+
+    def total_forces(self, force):
+        # total force on every rune from every other rune, from the same snapshot of positions
+        if self.neighbors is None:
+            delta_x, delta_y = self.pair_forces(force)
+            return np.cumsum(delta_x, axis=1)[:, -1], np.cumsum(delta_y, axis=1)[:, -1]
+
+        first, second = self.neighbors.first, self.neighbors.second
+        if force.kernel is None:
+            deltas = [force(self.runes[i], self.runes[j]) for i, j in zip(first.tolist(), second.tolist())]
+            delta_x = np.array([d[0] for d in deltas], dtype=float)
+            delta_y = np.array([d[1] for d in deltas], dtype=float)
+        else:
+            delta_x, delta_y = force.kernel(self.x[first], self.y[first], self.radius[first], self.x[second], self.y[second], self.radius[second])
+        within = self.neighbors.within(first, second)
+        # pairs are sorted by first then second rune, and bincount adds them in that order
+        n = len(self.runes)
+        total_x = np.bincount(first, weights=np.where(within, delta_x, 0.0), minlength=n)
+        total_y = np.bincount(first, weights=np.where(within, delta_y, 0.0), minlength=n)
+        return total_x, total_y
+
+    def sync(self, i = None):
+        indices = range(len(self.runes)) if i is None else [i]
+        for i in indices:
+            self.runes[i].x = float(self.x[i])
+            self.runes[i].y = float(self.y[i])
+
+    def step_sequential(self, precision):
+        if self.neighbors is not None:
+            self.neighbors.refresh()
+        for i in range(len(self.runes)):
+            for force in self.forces:
+                force_x, force_y = self.row_force(force, i)
+                self.x[i] += force_x * precision
+                self.y[i] += force_y * precision
+                if self.scalar:
+                    self.sync(i)
+
+    def step_jacobi(self, precision):
+        # every force sees the positions left by the previous force, like the sequential loop does per rune
+        if self.neighbors is not None:
+            self.neighbors.refresh()
+        for force in self.forces:
+            force_x, force_y = self.total_forces(force)
+            self.x += force_x * precision
+            self.y += force_y * precision
+            if self.scalar:
+                self.sync()
+
+    def run(self, iterations, precision, mode = "sequential", tolerance = None, adaptive = False, deadline = None):
+        stats = SimulationStats(precision)
+        start = time.perf_counter()
+        step = self.step_sequential if mode == "sequential" else self.step_jacobi
+        adaptive_step = AdaptiveStep(precision) if adaptive else None
+        for i in range(iterations):
+            check_deadline(deadline)
+            x, y = self.x.copy(), self.y.copy()
+            step(precision)
+            moves = (self.x - x, self.y - y)
+
+            stats.iterations = i+1
+            stats.residual = float(np.max(np.hypot(*moves))) if len(x) else 0.0
+            if tolerance is not None and stats.residual < tolerance:
+                stats.converged = True
+                break
+            if adaptive_step is not None:
+                precision = adaptive_step.update(moves[0].tolist(), moves[1].tolist())
+
+        self.sync()
+        for rune in self.runes:
+            rune.bounds()
+        stats.precision = precision
+        stats.wall_time = time.perf_counter() - start
+        return stats
+
+class NeighborList:
+    # verlet list of the rune pairs a ForceEngine with a cutoff looks at
+    # a pair interacts while its centers are at most radius + radius + cutoff apart; both built in
+    # forces fall off fast past the edges (edge_attraction with 1/(deviation+4)^2, strong_centration
+    # not at all outside the other rune), so distant pairs barely matter
+    # candidates are found with a cell list and kept with an extra skin, so the list is only rebuilt
+    # once some rune has moved more than half the skin since the last build
+    def __init__(self, engine, cutoff, skin = None):
+        self.engine = engine
+        self.cutoff = cutoff
+        self.skin = cutoff/2 if skin is None else skin
+        # runes without a radius are treated as points
+        self.radius = np.nan_to_num(engine.radius, nan=0.0)
+        self.builds = 0
+        self.build()
+
+    def build(self):
+        x, y, radius = self.engine.x, self.engine.y, self.radius
+        n = len(x)
+        reach = self.cutoff + self.skin
+        if n == 0:
+            self.first = self.second = np.zeros(0, dtype=np.intp)
+            self.starts = np.zeros(1, dtype=np.intp)
+            self.built_x, self.built_y = x.copy(), y.copy()
+            self.builds += 1
+            return
+
+        # any interacting pair is at most one cell apart in each direction
+        size = max(2*radius.max() + reach, 1e-9)
+        cell_x = np.floor((x - x.min())/size).astype(np.intp) + 1
+        cell_y = np.floor((y - y.min())/size).astype(np.intp) + 1
+        stride = cell_y.max() + 2
+        keys = cell_x*stride + cell_y
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+
+        firsts, seconds = [], []
+        for offset_x in (-1, 0, 1):
+            for offset_y in (-1, 0, 1):
+                target = keys + offset_x*stride + offset_y
+                start = np.searchsorted(sorted_keys, target, "left")
+                counts = np.searchsorted(sorted_keys, target, "right") - start
+                first = np.repeat(np.arange(n), counts)
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                firsts.append(first)
+                seconds.append(order[np.repeat(start, counts) + offsets])
+        first = np.concatenate(firsts)
+        second = np.concatenate(seconds)
+
+        distance = np.hypot(x[second] - x[first], y[second] - y[first])
+        keep = (first != second) & (distance <= radius[first] + radius[second] + reach)
+        first, second = first[keep], second[keep]
+        order = np.lexsort((second, first))
+        self.first, self.second = first[order], second[order]
+        self.starts = np.searchsorted(self.first, np.arange(n+1))
+        self.built_x, self.built_y = x.copy(), y.copy()
+        self.builds += 1
 
-def predefined():
+    def refresh(self):
+        x, y = self.engine.x, self.engine.y
+        if len(x) and np.max(np.hypot(x - self.built_x, y - self.built_y)) > self.skin/2:
+            self.build()
+
+    def row(self, i):
+        return self.second[self.starts[i]:self.starts[i+1]]
+
+    def within(self, first, second):
+        # the exact cutoff test on current positions, so results don't depend on when the list was built
+        x, y, radius = self.engine.x, self.engine.y, self.radius
+        distance = np.hypot(x[second] - x[first], y[second] - y[first])
+        return distance <= radius[first] + radius[second] + self.cutoff
+
+def predefined(deadline = None, rng = None, count = 5, size = 15):
+    return render(predefined_runes(deadline, rng, count, size))
+
+def predefined_bytes(deadline = None, rng = None, count = 5, size = 15):
+    # predefined, already encoded the way it goes out over http
+    return render_bytes(predefined_runes(deadline, rng, count, size))
+
+def predefined_runes(deadline = None, rng = None, count = 5, size = 15):
+    # count plain circles and a starred one, scattered over a square of +-size before the simulation
+    # pass a random.Random as rng for a layout that only depends on its seed (and count and size)
+    check_deadline(deadline)
+    if rng is None:
+        rng = random
     runes = []
-    for _ in range(5):
-        if random.random() < 0.5:
-            rune = Circle(random.randint(-15,15),random.randint(-15,15),random.randint(3,18))
+    for _ in range(count):
+        if rng.random() < 0.5:
+            rune = Circle(rng.randint(-size,size),rng.randint(-size,size),rng.randint(3,18))
             runes.append(rune)
         else:
-            rune = Circle(random.randint(-15,15),random.randint(-15,15),random.randint(5,10), fill = ".")
+            rune = Circle(rng.randint(-size,size),rng.randint(-size,size),rng.randint(5,10), fill = ".")
             runes.append(rune)
-    rune = StarredCircle(random.randint(-15,15),random.randint(-15,15),random.randint(10,14),inverted = random.random() < 0.5)
+    rune = StarredCircle(rng.randint(-size,size),rng.randint(-size,size),rng.randint(10,14),inverted = rng.random() < 0.5, rng = rng)
     runes.append(rune)
 
-    simulate(runes, [edge_attraction, strong_centration], iterations = 10000, precision = 0.1)
-    return render(runes)
+    # stops once the layout has settled, the 10000 iterations are only a cap now
+    simulate(runes, [edge_attraction, strong_centration], iterations = 10000, precision = 0.1, tolerance = 0.01, adaptive = True, deadline = deadline)
+    return runes
+
+class ServerBusy(Exception):
+    pass
+
+class LayoutPool:
+    # keeps a bounded queue of ready-made layouts filled from background threads, so a request only has
+    # to take one off the queue. when the pool runs dry the layout is made on demand instead
+    # refill_rate caps how many layouts per second the workers make together (None for as fast as they can)
+    def __init__(self, generate, size = 32, workers = 1, refill_rate = None):
+        self.generate = generate
+        self.size = size
+        self.workers = workers
+        self.refill_rate = refill_rate
+        self.queue = queue.Queue(maxsize = size)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
+        self.hits = 0
+        self.misses = 0
+        self.produced = 0
+
+    def start(self):
+        self.stopped.clear()
+        for _ in range(self.workers):
+            thread = threading.Thread(target = self.produce, daemon = True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def produce(self):
+        while not self.stopped.is_set():
+            try:
+                layout = self.generate()
+            except (ServerBusy, TimeoutError):
+                # requests come first, try again once the workers have caught up
+                self.stopped.wait(0.1)
+                continue
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(layout, timeout = 0.1)
+                except queue.Full:
+                    continue
+                with self.lock:
+                    self.produced += 1
+                break
+            if self.refill_rate:
+                self.stopped.wait(self.workers / self.refill_rate)
+
+    def get(self):
+        try:
+            layout = self.queue.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                self.misses += 1
+            return self.generate()
+        with self.lock:
+            self.hits += 1
+        return layout
+
+    def stats(self):
+        with self.lock:
+            return {
+                "depth": self.queue.qsize(),
+                "size": self.size,
+                "workers": len(self.threads),
+                "hits": self.hits,
+                "misses": self.misses,
+                "produced": self.produced,
+            }
+
+class ProcessRunner:
+    # runs predefined_bytes() in a pool of worker processes, so concurrent requests aren't serialized on the GIL
+    # at most max_in_flight layouts are made at once and max_queued more wait for a worker, anything past
+    # that is turned away straight away with ServerBusy. each layout gets timeout seconds from the moment
+    # it is asked for, after which the worker abandons the simulation and the caller gets a TimeoutError
+    def __init__(self, max_in_flight = None, max_queued = None, timeout = 10.0):
+        self.max_in_flight = max_in_flight or os.cpu_count() or 1
+        self.max_queued = self.max_in_flight if max_queued is None else max_queued
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(self.max_in_flight + self.max_queued)
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.max_in_flight)
+
+    def warm(self):
+        # the executor only starts processes as work arrives, so fill every worker once up front
+        futures = [self.executor.submit(predefined_bytes) for _ in range(self.max_in_flight)]
+        concurrent.futures.wait(futures)
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures = True)
+
+    def __call__(self, **kwargs):
+        return self.run(predefined_bytes, **kwargs)
+
+    def runes(self, **kwargs):
+        # the simulated runes of a layout, for callers that render it themselves. the starred circle
+        # can't take the random module across to the worker, so it gets a Random of its own
+        kwargs.setdefault("rng", random.Random())
+        return self.run(predefined_runes, **kwargs)
+
+    def run(self, generate, **kwargs):
+        if not self.slots.acquire(blocking = False):
+            raise ServerBusy("all layout workers are busy")
+        try:
+            deadline = time.monotonic() + self.timeout
+            future = self.executor.submit(generate, deadline, **kwargs)
+            try:
+                # a little slack so the worker's own deadline check is what normally ends a slow layout
+                return future.result(timeout = self.timeout + 1.0)
+            except TimeoutError:
+                future.cancel()
+                raise
+        finally:
+            self.slots.release()
+
+class RenderCache:
+    # two level cache of finished layouts: an in-memory LRU holding at most max_bytes of encoded text, backed by
+    # an optional directory on disk that is checked on a memory miss and keeps everything ever stored
+    def __init__(self, max_bytes = 64*1024*1024, directory = None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok = True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest() + ".txt")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        if self.directory is None:
+            return None
+        try:
+            with open(self.path(key), "rb") as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+        self.remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self.remember(key, value)
+        if self.directory is not None:
+            # written next to the final name and renamed, so readers never see half a file
+            path = self.path(key)
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(temporary, "wb") as f:
+                f.write(value)
+            os.replace(temporary, path)
+
+    def remember(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last = False)
+                self.bytes -= len(evicted)
+
+# bump when a change makes the same seed give a different layout, so stale disk entries aren't served
+layout_version = 1
+
+# not started on import, so until it is every request is a miss and renders on demand
+pool = LayoutPool(predefined_bytes)
+cache = RenderCache()
 
 app = Flask(__name__)
 @app.route("/circle")
 def circle():
-    return predefined()
+    if "seed" not in request.args:
+        if request.args.get("stream"):
+            # made on demand, rows go out as soon as they are rendered in this thread. with worker
+            # processes the simulation runs in one of them, under the same limits and timeout as any layout
+            if isinstance(pool.generate, ProcessRunner):
+                runes = pool.generate.runes()
+            else:
+                runes = predefined_runes()
+            return Response(stream_with_context(render_rows(runes)), mimetype = "text/plain")
+        return pool.get()
+
+    seed = request.args.get("seed", type = int)
+    count = request.args.get("count", 5, type = int)
+    size = request.args.get("size", 15, type = int)
+    if seed is None or count is None or size is None or not 0 <= count <= 50 or not 1 <= size <= 200:
+        abort(400)
+
+    key = (layout_version, seed, count, size)
+    layout = cache.get(key)
+    if layout is None:
+        layout = pool.generate(rng = random.Random(seed), count = count, size = size)
+        cache.put(key, layout)
+
+    response = Response(layout, mimetype = "text/plain")
+    response.set_etag(hashlib.sha256(layout).hexdigest())
+    return response.make_conditional(request)
+
+@app.route("/circle/stats")
+def circle_stats():
+    return jsonify(pool.stats())
+
+@app.errorhandler(ServerBusy)
+def server_busy(error):
+    return str(error), 503, {"Retry-After": "1"}
+
+@app.errorhandler(TimeoutError)
+def layout_timeout(error):
+    return str(error), 504
 
 if __name__ == "__main__":
+    import argparse
     from waitress import serve
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pool-size", type = int, default = 32, help = "layouts to keep ready (0 to always render on demand)")
+    parser.add_argument("--pool-workers", type = int, default = 1, help = "background threads refilling the pool")
+    parser.add_argument("--refill-rate", type = float, default = None, help = "max layouts per second the pool makes")
+    parser.add_argument("--processes", action = "store_true", help = "make layouts in worker processes instead of server threads")
+    parser.add_argument("--max-in-flight", type = int, default = None, help = "worker processes, layouts made at once (default: cpu count)")
+    parser.add_argument("--max-queued", type = int, default = None, help = "layouts waiting for a worker before requests get a 503 (default: max in flight)")
+    parser.add_argument("--timeout", type = float, default = 10.0, help = "seconds a layout may take before the request gets a 504")
+    parser.add_argument("--cache-bytes", type = int, default = 64*1024*1024, help = "memory for seeded layouts")
+    parser.add_argument("--cache-dir", default = None, help = "directory to keep seeded layouts in across restarts")
+    args = parser.parse_args()
+
+    cache = RenderCache(args.cache_bytes, args.cache_dir)
+
+    generate = predefined_bytes
+    if args.processes:
+        generate = ProcessRunner(args.max_in_flight, args.max_queued, args.timeout)
+        generate.warm()
+    pool = LayoutPool(generate, max(args.pool_size, 1), args.pool_workers, args.refill_rate)
+    if args.pool_size > 0:
+        pool.start()
     serve(app, host="127.0.0.1", port=8080)